@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2022 Raymond Olsen
+#
+# This file is part of PyLibby.
+#
+# PyLibby is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyLibby is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyLibby. If not, see <http://www.gnu.org/licenses/>.
+
+# Times the main things PyLibby does against the local stub server, no network needed.
+#
+#     python benchmarks/bench.py --latency 0.05 --bandwidth 20000000 --repeat 5 --budget download=3
+#
+# Exits with 1 if a scenario is slower than its --budget (median seconds), so it can be used to catch regressions.
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from tabulate import tabulate
+
+from pylibby import Libby, MediaInfoCache, Stats
+from stub_server import StubServer
+
+
+def make_libby(server: StubServer, id_path: str, stats: Stats, workers: int, retries: int) -> Libby:
+    return Libby(id_path, pool_size=max(10, workers), cache=MediaInfoCache(), stats=stats, retries=retries,
+                 sentry_url=server.url, thunder_url=server.url)
+
+
+def bench_login(server, id_path, tmp, args, stats):
+    make_libby(server, id_path, stats, args.workers, args.retries)
+
+
+def bench_list_loans(server, id_path, tmp, args, stats):
+    # What -ls does
+    L = make_libby(server, id_path, stats, args.workers, args.retries)
+    loans = L.get_loans()
+    media_infos = L.get_media_infos([lo["id"] for lo in loans])
+    for lo in loans:
+        L.get_author_by_media_info(media_infos[lo["id"]])
+        L.get_narrator_by_media_info(media_infos[lo["id"]])
+
+
+def bench_search(server, id_path, tmp, args, stats):
+    L = make_libby(server, id_path, stats, args.workers, args.retries)
+    for _ in L.iter_search("title", per_page=10):
+        pass
+
+
+def bench_borrow(server, id_path, tmp, args, stats):
+    L = make_libby(server, id_path, stats, args.workers, args.retries)
+    # The last title is never on loan, and only available at one of the libraries
+    title_id = max(server.media, key=int)
+    if not L.borrow_book_on_any_logged_in_library(title_id):
+        raise RuntimeError("Borrow failed.")
+    L.return_book(title_id)
+
+
+def bench_download(server, id_path, tmp, args, stats):
+    L = make_libby(server, id_path, stats, args.workers, args.retries)
+    output_path = os.path.join(tmp, "download")
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.makedirs(output_path)
+    loan = next(lo for lo in L.get_loans() if lo["type"]["id"] == "audiobook")
+    L.download_audiobook_mp3(loan, output_path, callback_functions=[lambda f, mb: None], workers=args.workers)
+
+
+# Modules that are slow to import and must not be loaded unless they are used
+LAZY_MODULES = ["requests", "tabulate", "concurrent.futures", "pylibby_transport"]
+
+
+def bench_startup_import(server, id_path, tmp, args, stats):
+    # A fresh interpreter, so nothing is imported already
+    check = f"import sys, pylibby; print([m for m in {LAZY_MODULES!r} if m in sys.modules])"
+    loaded = subprocess.run([sys.executable, "-c", check], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    if loaded.strip() != "[]":
+        raise RuntimeError(f"Importing pylibby also imported {loaded.strip()}.")
+
+
+def bench_startup_cli(server, id_path, tmp, args, stats):
+    # A local only command, the way it would be run from cron, shouldn't log in or load the HTTP stack
+    subprocess.run([sys.executable, os.path.join(ROOT, "pylibby.py"), "-id", id_path,
+                    "--index-file", os.path.join(tmp, "index.sqlite"), "-sl", "title", "-j"],
+                   capture_output=True, check=True)
+
+
+SCENARIOS = {
+    "login": bench_login,
+    "list_loans": bench_list_loans,
+    "search": bench_search,
+    "borrow": bench_borrow,
+    "download": bench_download,
+    "startup_import": bench_startup_import,
+    "startup_cli": bench_startup_cli,
+}
+
+# Checked even without --budget. Generous, they are there to catch something heavy getting imported at startup.
+DEFAULT_BUDGETS = {
+    "startup_import": 0.5,
+    "startup_cli": 0.75,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark PyLibby against a local stub server.")
+    parser.add_argument("scenarios", nargs="*", help=f"Which scenarios to run, defaults to all of {', '.join(SCENARIOS)}.")
+    parser.add_argument("--repeat", type=int, default=3, help="How many times to run each scenario.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds the stub adds to every request.")
+    parser.add_argument("--bandwidth", type=float, help="Bytes per second the stub sends files with.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests the stub answers with 503.")
+    parser.add_argument("--loans", type=int, default=30)
+    parser.add_argument("--parts", type=int, default=8)
+    parser.add_argument("--part-size", type=int, default=2000000)
+    parser.add_argument("--workers", type=int, default=4, help="Parallel downloads.")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--budget", action="append", default=[], metavar="scenario=seconds",
+                        help="Fail if the median time of a scenario is above this.")
+    parser.add_argument("--json", action="store_true", help="Output results as JSON.")
+    args = parser.parse_args()
+
+    budgets = dict(DEFAULT_BUDGETS)
+    for budget in args.budget:
+        name, _, seconds = budget.partition("=")
+        budgets[name] = float(seconds)
+
+    server = StubServer(latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate,
+                        titles=max(50, args.loans + 1), loans=args.loans, parts=args.parts,
+                        part_size=args.part_size).start()
+    tmp = tempfile.mkdtemp(prefix="pylibby-bench-")
+    id_path = os.path.join(tmp, "id.json")
+    with open(id_path, "w") as w:
+        w.write(json.dumps({"identity": "stub-identity"}))
+
+    results = []
+    failed = False
+    try:
+        for name in args.scenarios or SCENARIOS:
+            times = []
+            stats = Stats()
+            for _ in range(args.repeat):
+                # Libby prints what it's doing, that's not what we want to see here
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    start = time.perf_counter()
+                    SCENARIOS[name](server, id_path, tmp, args, stats)
+                    times.append(time.perf_counter() - start)
+            summary = stats.summary()["endpoints"]
+            median = statistics.median(times)
+            result = {
+                "Scenario": name,
+                "Median s": round(median, 4),
+                "Min s": round(min(times), 4),
+                "Max s": round(max(times), 4),
+                "Requests": sum(e["calls"] for e in summary.values()) // args.repeat,
+                "Retries": sum(e["retries"] for e in summary.values()) // args.repeat,
+                "MB": round(sum(e["bytes"] for e in summary.values()) / args.repeat / 1000000, 2),
+            }
+            if name in budgets:
+                result["Budget s"] = budgets[name]
+                if median > budgets[name]:
+                    failed = True
+                    result["Budget s"] = f"{budgets[name]} EXCEEDED"
+            results.append(result)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(tabulate(results, headers="keys", tablefmt="grid"))
+    sys.exit(1 if failed else 0)
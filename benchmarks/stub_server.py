@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2022 Raymond Olsen
+#
+# This file is part of PyLibby.
+#
+# PyLibby is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyLibby is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyLibby. If not, see <http://www.gnu.org/licenses/>.
+
+# A local stand-in for the OverDrive endpoints PyLibby uses, so it can be run (and timed) without network.
+# Both the sentry-read and the thunder endpoints are served from the same address, give it to Libby as
+# sentry_url and thunder_url. Latency, bandwidth and errors can be injected.
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import socket
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, bandwidth: float = None,
+                 error_rate: float = 0.0, titles: int = 50, cards: int = 3, loans: int = 10, parts: int = 8,
+                 part_size: int = 1000000, seed: int = 1):
+        # latency is seconds added to every request, bandwidth is bytes per second for files (None is unlimited),
+        # error_rate is the share of requests that get a 503
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.parts = parts
+        self.part_size = part_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.part_data = bytes(range(256)) * (part_size // 256) + bytes(part_size % 256)
+
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_port}"
+        self.thread = None
+
+        self.cards = [{"cardId": str(100 + i), "advantageKey": f"library{i}",
+                       "counts": {"loan": 0}, "limits": {"loan": 100}} for i in range(cards)]
+        self.media = {}
+        for i in range(titles):
+            title_id = str(1000 + i)
+            audiobook = i % 2 == 0
+            self.media[title_id] = {
+                "id": title_id,
+                "title": f"Title {i}",
+                "type": {"id": "audiobook" if audiobook else "ebook"},
+                "creators": [{"name": f"Author {i % 7}", "role": "Author"}] +
+                            ([{"name": f"Narrator {i % 5}", "role": "Narrator"}] if audiobook else []),
+                "formats": [{"id": "audiobook-mp3" if audiobook else "ebook-epub-adobe",
+                             "identifiers": [{"type": "ISBN", "value": f"978{i:010d}"}]}],
+                "languages": [{"id": "en", "Name": "English"}],
+                "publishDate": "2020-01-01T00:00:00",
+                "covers": {"cover150Wide": {"href": f"{self.url}/covers/{title_id}.jpg"}},
+                "siteAvailabilities": {c["advantageKey"]: {"isAvailable": self.is_available(c["advantageKey"], title_id)}
+                                       for c in self.cards},
+            }
+        self.loans = []
+        for title_id in list(self.media)[:loans]:
+            self.add_loan(self.cards[int(title_id) % len(self.cards)]["cardId"], title_id)
+
+    def start(self) -> "StubServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def is_available(self, library: str, title_id: str) -> bool:
+        # Every title is available at exactly one library, which one depends on the id
+        return library == f"library{int(title_id) % len(self.cards)}"
+
+    def add_loan(self, card_id: str, title_id: str) -> dict:
+        media = self.media[title_id]
+        loan = {"id": title_id, "title": media["title"], "cardId": card_id, "type": media["type"],
+                "formats": [{"id": f["id"]} for f in media["formats"]], "covers": media["covers"],
+                "expireDate": "2030-01-01T00:00:00Z"}
+        self.loans.append(loan)
+        next(c for c in self.cards if c["cardId"] == card_id)["counts"]["loan"] += 1
+        return loan
+
+    def remove_loan(self, card_id: str, title_id: str) -> bool:
+        for loan in self.loans:
+            if loan["id"] == title_id and loan["cardId"] == card_id:
+                self.loans.remove(loan)
+                next(c for c in self.cards if c["cardId"] == card_id)["counts"]["loan"] -= 1
+                return True
+        return False
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Headers and body are written separately, without this Nagle adds ~40ms to every response
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data, status: int = 200):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_file(self, data: bytes, content_type: str):
+                etag = '"' + hashlib.md5(data).hexdigest() + '"'
+                start = 0
+                range_ = self.headers.get("Range")
+                if_range = self.headers.get("If-Range")
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if range_ and (not if_range or if_range == etag):
+                    start = int(re.match(r"bytes=(\d+)-", range_).group(1))
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{len(data)}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data) - start))
+                self.send_header("ETag", etag)
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+                view = memoryview(data)[start:]
+                chunk = 64 * 1024
+                for i in range(0, len(view), chunk):
+                    self.wfile.write(view[i:i + chunk])
+                    if stub.bandwidth:
+                        time.sleep(min(chunk, len(view) - i) / stub.bandwidth)
+
+            def handle_request(self, method: str):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                with stub.lock:
+                    stub.requests += 1
+                    fail = stub.random.random() < stub.error_rate
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if fail:
+                    self.send_response(503)
+                    self.send_header("Retry-After", "0")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                url = urllib.parse.urlsplit(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                p = url.path.rstrip("/") or "/"
+                with stub.lock:
+                    response = self.route(method, p, query, body)
+                if response is None:
+                    self.send_json({"errorCode": "NotFound"}, 404)
+                elif isinstance(response, tuple) and isinstance(response[0], bytes):
+                    self.send_file(*response)
+                elif isinstance(response, tuple):
+                    self.send_json(*response)
+                else:
+                    self.send_json(response)
+
+            def route(self, method: str, p: str, query: dict, body: bytes):
+                # sentry-read
+                if method == "POST" and p == "/chip":
+                    return {"chip": "stub-chip", "identity": "stub-identity", "syncable": False, "primary": True}
+                if method == "POST" and p == "/chip/clone/code":
+                    return {"result": "cloned"}
+                if method == "GET" and p == "/chip/sync":
+                    return {"result": "synchronized", "cards": stub.cards, "loans": stub.loans, "holds": []}
+                m = re.fullmatch(r"/card/(\w+)/loan/(\w+)", p)
+                if m and method == "POST":
+                    card_id, title_id = m.groups()
+                    if title_id not in stub.media:
+                        return None
+                    library = next(c["advantageKey"] for c in stub.cards if c["cardId"] == card_id)
+                    if not stub.is_available(library, title_id):
+                        return {"result": "title_not_available"}, 400
+                    return stub.add_loan(card_id, title_id)
+                if m and method == "DELETE":
+                    return {} if stub.remove_loan(*m.groups()) else ({"result": "loan_not_found"}, 404)
+                m = re.fullmatch(r"/card/(\w+)/loan/(\w+)/fulfill/([\w-]+)", p)
+                if m and method == "GET":
+                    return {"fulfill": {"href": f"{stub.url}/files/{m.group(2)}.{'odm' if 'audiobook' in m.group(3) else 'acsm'}"}}
+                m = re.fullmatch(r"/open/(audiobook|book)/card/(\w+)/title/(\w+)", p)
+                if m and method == "GET":
+                    title_id = m.group(3)
+                    return {"message": "stub-message", "urls": {"web": f"{stub.url}/web/{title_id}/",
+                                                                "openbook": f"{stub.url}/openbook/{title_id}"}}
+                m = re.fullmatch(r"/openbook/(\w+)", p)
+                if m and method == "GET":
+                    return {"spine": [{"path": f"Part{i + 1:02d}.mp3", "-odread-file-bytes": stub.part_size}
+                                      for i in range(stub.parts)]}
+                if re.fullmatch(r"/web/\w+", p) and method == "GET":
+                    return {}
+                if re.fullmatch(r"/web/\w+/Part\d+\.mp3", p) and method == "GET":
+                    return stub.part_data, "audio/mpeg"
+                if re.fullmatch(r"/files/\w+\.\w+", p) and method == "GET":
+                    return b"<stub/>" * 100, "application/xml"
+                if re.fullmatch(r"/covers/\w+\.jpg", p) and method == "GET":
+                    return hashlib.sha256(p.encode()).digest() * 1000, "image/jpeg"
+
+                # thunder
+                if method != "GET":
+                    return None
+                if p == "/v2/media/bulk":
+                    ids = ",".join(query.get("titleIds", [])).split(",")
+                    return [stub.media[i] for i in ids if i in stub.media]
+                if p == "/v2/media/search":
+                    words = " ".join(query.get("query", [])).lower()
+                    media_types = query.get("mediaTypes")
+                    hits = [m for m in stub.media.values() if words in m["title"].lower()
+                            and (not media_types or m["type"]["id"] in media_types)]
+                    page = int(query.get("page", ["1"])[0])
+                    per_page = int(query.get("perPage", ["24"])[0])
+                    return hits[(page - 1) * per_page:page * per_page]
+                m = re.fullmatch(r"/v2/media/(\w+)", p)
+                if m:
+                    return stub.media.get(m.group(1))
+                m = re.fullmatch(r"/v2/libraries/(\w+)/media/(\w+)/availability", p)
+                if m:
+                    available = stub.is_available(*m.groups())
+                    return {"id": m.group(2), "isAvailable": available, "availableCopies": 1 if available else 0,
+                            "estimatedWaitDays": 0 if available else 14}
+                return None
+
+            def do_GET(self):
+                self.handle_request("GET")
+
+            def do_POST(self):
+                self.handle_request("POST")
+
+            def do_DELETE(self):
+                self.handle_request("DELETE")
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OverDrive endpoints used by PyLibby.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request.")
+    parser.add_argument("--bandwidth", type=float, help="Bytes per second for file downloads.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503.")
+    parser.add_argument("--titles", type=int, default=50)
+    parser.add_argument("--loans", type=int, default=10)
+    parser.add_argument("--parts", type=int, default=8)
+    parser.add_argument("--part-size", type=int, default=1000000)
+    args = parser.parse_args()
+    server = StubServer(port=args.port, latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate,
+                        titles=args.titles, loans=args.loans, parts=args.parts, part_size=args.part_size)
+    print(f"Serving on {server.url}")
+    server.httpd.serve_forever()
@@ -18,21 +18,869 @@
 # along with PyLibby. If not, see <http://www.gnu.org/licenses/>.
 
 import json
+import base64
+import csv
 import sys
 import urllib.parse
-import requests
 import os
-from typing import Callable
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
 from os import path
 import datetime
 import argparse
-from tabulate import tabulate
+import atexit
+import threading
+import hashlib
+import sqlite3
+import shutil
+import tempfile
+import textwrap
+import time
+from collections import OrderedDict
+
+# Stats and TokenBucket are also used by pylibby_transport, so they live in a module of their own
+from pylibby_common import Stats, TokenBucket
+
+if TYPE_CHECKING:
+    from pylibby_transport import LibbyAdapter
+
+
+def __getattr__(name: str):
+    # LibbyAdapter lives in pylibby_transport, which imports requests, so it is only loaded when asked for
+    if name == "LibbyAdapter":
+        from pylibby_transport import LibbyAdapter
+        return LibbyAdapter
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class DownloadManifest:
+    # Keeps track of what has been downloaded for a book, so interrupted downloads can be resumed
+    # and finished files don't have to be downloaded again.
+    filename = "pylibby_manifest.json"
+
+    def __init__(self, folder: str):
+        self.path = os.path.join(folder, self.filename)
+        self.lock = threading.Lock()
+        self.data = {"complete": False, "files": {}}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, "r") as r:
+                    self.data.update(json.loads(r.read()))
+            except ValueError:
+                # A broken manifest just means we have to check everything again
+                pass
+
+    @property
+    def complete(self) -> bool:
+        return self.data["complete"]
+
+    def get(self, name: str) -> dict:
+        with self.lock:
+            return dict(self.data["files"].get(name, {}))
+
+    def update(self, name: str, save=True, **fields):
+        with self.lock:
+            self.data["files"].setdefault(name, {}).update(fields)
+            if save:
+                self._save()
+
+    def is_done(self, name: str, folder: str) -> bool:
+        entry = self.get(name)
+        file_path = os.path.join(folder, name)
+        if not entry.get("done") or not os.path.isfile(file_path):
+            return False
+        return entry.get("size") is None or os.path.getsize(file_path) == entry["size"]
+
+    def set_complete(self, complete: bool = True):
+        with self.lock:
+            self.data["complete"] = complete
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as w:
+            w.write(json.dumps(self.data, indent=4, sort_keys=True))
+        os.replace(tmp_path, self.path)
+
+
+class AssetStore:
+    # Keeps covers (and other small files) once, named by their SHA-256, and links them into the book folders.
+    # The same cover is often used by the ebook and the audiobook, and every download used to fetch it again.
+    # index.json remembers the ETag of every href, so an unchanged cover only costs a 304.
+    def __init__(self, path_: str):
+        self.path = path_
+        self.index_path = os.path.join(path_, "index.json")
+        self.lock = threading.Lock()
+        self.index = {}
+        os.makedirs(os.path.join(path_, "objects"), exist_ok=True)
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, "r") as r:
+                    self.index = json.loads(r.read())
+            except ValueError:
+                # Without the index everything is just downloaded once more
+                pass
+
+    def get_object_path(self, sha256: str) -> str:
+        return os.path.join(self.path, "objects", sha256[:2], sha256)
+
+    def get(self, href: str) -> dict:
+        # Only returns what we still have the file for
+        with self.lock:
+            entry = dict(self.index.get(href, {}))
+        if entry and os.path.isfile(self.get_object_path(entry["sha256"])):
+            return entry
+        return {}
 
-class Libby:
+    def get_tmp_path(self) -> str:
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        os.close(fd)
+        return tmp_path
+
+    def add(self, tmp_path: str, href: str, etag: str = None, last_modified: str = None) -> str:
+        # Moves a downloaded file into the store and returns its hash
+        h = hashlib.sha256()
+        with open(tmp_path, "rb") as r:
+            for data in iter(lambda: r.read(1024 * 1024), b""):
+                h.update(data)
+        sha256 = h.hexdigest()
+        object_path = self.get_object_path(sha256)
+        if os.path.isfile(object_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(tmp_path, object_path)
+        with self.lock:
+            self.index[href] = {"sha256": sha256, "etag": etag, "last_modified": last_modified,
+                                "size": os.path.getsize(object_path)}
+            self._save()
+        return sha256
+
+    def link(self, sha256: str, file_path: str):
+        # Hardlink if we can, symlink if we can't (other file system), and copy as the last resort
+        object_path = self.get_object_path(sha256)
+        tmp_path = file_path + ".part"
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(object_path, tmp_path)
+        except OSError:
+            try:
+                os.symlink(os.path.abspath(object_path), tmp_path)
+            except OSError:
+                shutil.copyfile(object_path, tmp_path)
+        os.replace(tmp_path, file_path)
+
+    def _save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as w:
+            w.write(json.dumps(self.index, indent=4, sort_keys=True))
+        os.replace(tmp_path, self.index_path)
+
+
+class HashStage:
+    # Hashes a file while it is downloaded, so it doesn't have to be read again afterwards. The hash ends up in
+    # the manifest and is of the file as it is on disk, so it has to come after stages that change the file.
+    # Those (like ID3Stage) only touch the last 128 bytes, so those are held back and read again in finish.
+    held_back = 128
+
+    def __init__(self, algorithm: str = "sha256"):
+        self.algorithm = algorithm
+        self.hash = None
+        self.hashed = 0
+        self.tail = b""
+
+    def start(self, tmp_path: str, offset: int):
+        self.hash = hashlib.new(self.algorithm)
+        self.hashed = max(0, offset - self.held_back)
+        self.tail = b""
+        if offset:
+            # Resuming, what we already have has to be hashed too
+            with open(tmp_path, "rb") as r:
+                while r.tell() < self.hashed:
+                    data = r.read(min(1024 * 1024, self.hashed - r.tell()))
+                    if not data:
+                        break
+                    self.hash.update(data)
+                self.tail = r.read(offset - self.hashed)
+
+    def update(self, data: memoryview):
+        if len(data) >= self.held_back:
+            self.hash.update(self.tail)
+            self.hash.update(data[:-self.held_back])
+            self.hashed += len(self.tail) + len(data) - self.held_back
+            self.tail = bytes(data[-self.held_back:])
+        else:
+            tail = self.tail + bytes(data)
+            self.hash.update(tail[:-self.held_back])
+            self.hashed += max(0, len(tail) - self.held_back)
+            self.tail = tail[-self.held_back:]
+
+    def finish(self, w, completed: int) -> dict:
+        # Whatever the stages before us did to the end of the file, hash it as it is now
+        w.seek(self.hashed)
+        self.hash.update(w.read())
+        return {self.algorithm: self.hash.hexdigest()}
+
+
+class ID3Stage:
+    # Puts an ID3v1 tag (part number, title, author and year from media info) at the end of an mp3 while it is
+    # downloaded. ID3v1 lives in the last 128 bytes, so it can be written when the stream ends, and if the part
+    # already ends with a tag that one is replaced.
+    def __init__(self, media_info: dict, track: int, author: str = ""):
+        self.media_info = media_info
+        self.track = track
+        self.author = author
+        self.tail = b""
+
+    def start(self, tmp_path: str, offset: int):
+        self.tail = b""
+        if offset:
+            with open(tmp_path, "rb") as r:
+                r.seek(max(0, offset - 128))
+                self.tail = r.read(min(128, offset))
+
+    def update(self, data: memoryview):
+        self.tail = (self.tail + bytes(data[-128:]))[-128:]
+
+    def get_tag(self) -> bytes:
+        def field(value: str, length: int) -> bytes:
+            return value.encode("latin-1", "replace")[:length].ljust(length, b"\0")
+
+        title = self.media_info.get("title", "")
+        year = self.media_info.get("publishDate", "")[:4]
+        # 101 is "Speech"
+        return b"TAG" + field(f"{title} - Part {self.track}", 30) + field(self.author, 30) + field(title, 30) + \
+            field(year, 4) + field("", 28) + b"\0" + bytes([min(self.track, 255)]) + bytes([101])
+
+    def finish(self, w, completed: int) -> dict:
+        position = completed - 128 if len(self.tail) == 128 and self.tail.startswith(b"TAG") else completed
+        w.seek(position)
+        w.write(self.get_tag())
+        w.truncate()
+        return {"id3": True}
+
+
+class PartWriter:
+    # Writes a part to its .part file from offset on, and keeps the stages, the progress callback and the
+    # manifest up to date while doing it. Libby and AsyncLibby only differ in how they read the response.
+    def __init__(self, tmp_path: str, offset: int, filename: str, manifest: DownloadManifest,
+                 callback: Callable[[str, int], None], size: int = None, stages: list = ()):
+        self.filename = filename
+        self.manifest = manifest
+        self.callback = callback
+        self.stages = stages
+        self.file = open(tmp_path, "r+b" if offset else "wb")
+        self.file.seek(offset)
+        self.file.truncate()
+        if size and size > offset and hasattr(os, "posix_fallocate"):
+            # Reserve the space up front instead of growing the file a bit at a time
+            os.posix_fallocate(self.file.fileno(), offset, size - offset)
+        for stage in stages:
+            stage.start(tmp_path, offset)
+        self.offset = offset
+        self.completed = offset
+        self.saved = offset
+        self.mb = offset // (1024 * 1000)
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.progress(len(data), memoryview(data))
+
+    def progress(self, n: int, data: memoryview):
+        # Called after n bytes (data) have been written to self.file
+        self.completed += n
+        for stage in self.stages:
+            stage.update(data)
+        if self.completed // (1024 * 1000) > self.mb:
+            self.mb = self.completed // (1024 * 1000)
+            self.callback(self.filename, self.mb)
+        if self.completed - self.saved >= 5 * 1024 * 1000:
+            # Don't rewrite the manifest for every chunk, every few MB is enough to resume from
+            self.file.flush()
+            self.manifest.update(self.filename, completed=self.completed)
+            self.saved = self.completed
+
+    def close(self):
+        # Also record how far we got when the connection breaks, that is what makes resuming possible
+        self.file.close()
+        self.manifest.update(self.filename, completed=self.completed)
+
+
+class MediaInfoCache:
+    # Media info hardly ever changes, so we keep it in memory (LRU) and optionally in a SQLite file
+    # so that it survives between runs.
+    def __init__(self, db_path: str = None, ttl: float = 7 * 24 * 60 * 60, max_memory: int = 256, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS media_info "
+                            "(title_id TEXT PRIMARY KEY, fetched REAL NOT NULL, data TEXT NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS media_info_fetched ON media_info (fetched)")
+            self.db.commit()
+
+    def get(self, title_id: str) -> Optional[dict]:
+        now = time.time()
+        with self.lock:
+            if title_id in self.memory:
+                fetched, media_info = self.memory[title_id]
+                if now - fetched < self.ttl:
+                    self.memory.move_to_end(title_id)
+                    return media_info
+                del self.memory[title_id]
+            if self.db:
+                row = self.db.execute("SELECT fetched, data FROM media_info WHERE title_id = ?", (title_id,)).fetchone()
+                if row and now - row[0] < self.ttl:
+                    media_info = json.loads(row[1])
+                    self._remember(title_id, row[0], media_info)
+                    return media_info
+        return None
+
+    def put(self, title_id: str, media_info: dict):
+        self.put_many({title_id: media_info})
+
+    def put_many(self, media_infos: dict[str, dict]):
+        # Many titles (like a bulk answer) in one transaction, title id -> media info
+        now = time.time()
+        with self.lock:
+            for title_id, media_info in media_infos.items():
+                self._remember(title_id, now, media_info)
+            if self.db and media_infos:
+                self.db.executemany("INSERT OR REPLACE INTO media_info (title_id, fetched, data) VALUES (?, ?, ?)",
+                                    [(title_id, now, json.dumps(media_info)) for title_id, media_info in media_infos.items()])
+                # Throw out expired entries, and the oldest ones if the file has grown too big
+                self.db.execute("DELETE FROM media_info WHERE fetched < ?", (now - self.ttl,))
+                if self.db.execute("SELECT COUNT(*) FROM media_info").fetchone()[0] > self.max_entries:
+                    self.db.execute("DELETE FROM media_info WHERE title_id NOT IN "
+                                    "(SELECT title_id FROM media_info ORDER BY fetched DESC LIMIT ?)", (self.max_entries,))
+                self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.db:
+                self.db.execute("DELETE FROM media_info")
+                self.db.commit()
+
+    def _remember(self, title_id: str, fetched: float, media_info: dict):
+        self.memory[title_id] = (fetched, media_info)
+        self.memory.move_to_end(title_id)
+        while len(self.memory) > self.max_memory:
+            self.memory.popitem(last=False)
+
+
+class TitleIndex:
+    # A local full text index (SQLite FTS5) of every title we have seen, from media info, search hits and the
+    # info.json/loan.json files in the download folder, so we can search what we've had without asking OverDrive.
+    columns = ["title", "authors", "narrators", "series", "isbn", "languages", "publisher"]
+
+    def __init__(self, db_path: str = ":memory:"):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS titles USING fts5 (title_id UNINDEXED, type UNINDEXED, "
+                        f"{', '.join(self.columns)}, path UNINDEXED, seen UNINDEXED)")
+        self.db.commit()
+        self.libby = LibbyBase()
+
+    def add(self, media_infos: list[dict], path_: str = None):
+        # A title keeps the path it was downloaded to when we see it again somewhere else
+        rows = []
+        for media_info in media_infos:
+            entry = self.libby.get_index_entry(media_info)
+            if entry:
+                rows.append(entry)
+        if not rows:
+            return
+        now = time.time()
+        with self.lock:
+            for entry in rows:
+                old = self.db.execute("SELECT path FROM titles WHERE title_id = ?", (entry["id"],)).fetchone()
+                self.db.execute("DELETE FROM titles WHERE title_id = ?", (entry["id"],))
+                self.db.execute(f"INSERT INTO titles (title_id, type, {', '.join(self.columns)}, path, seen) "
+                                f"VALUES ({', '.join('?' * (len(self.columns) + 4))})",
+                                [entry["id"], entry["type"]] + [entry[c] for c in self.columns] +
+                                [path_ or (old[0] if old else None), now])
+            self.db.commit()
+
+    def get_match(self, query: str) -> str:
+        # Every word is matched as a prefix, "author:tolkien" only looks at one column
+        terms = []
+        for word in query.split():
+            column, _, value = word.partition(":")
+            if value and column in self.columns:
+                terms.append(f'{column} : "{value.replace(chr(34), "")}"*')
+            elif word.replace('"', ""):
+                terms.append(f'"{word.replace(chr(34), "")}"*')
+        return " ".join(terms)
+
+    def search(self, query: str, limit: int = 50) -> list[dict]:
+        match = self.get_match(query)
+        if not match:
+            return []
+        with self.lock:
+            rows = self.db.execute(f"SELECT title_id, type, {', '.join(self.columns)}, path FROM titles "
+                                   "WHERE titles MATCH ? ORDER BY rank LIMIT ?", (match, limit)).fetchall()
+        return [dict(zip(["id", "type"] + self.columns + ["path"], row)) for row in rows]
+
+    def reindex(self, path_: str) -> int:
+        # Reads every info.json (audiobooks) and loan.json (ebooks) below path_, returns how many were found
+        count = 0
+        for folder, _, files in os.walk(path_):
+            for name in ("info.json", "loan.json"):
+                if name in files:
+                    try:
+                        with open(os.path.join(folder, name), "r") as r:
+                            data = json.loads(r.read())
+                    except ValueError:
+                        continue
+                    self.add([data.get("media_info", data)], folder)
+                    count += 1
+        return count
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM titles")
+            self.db.commit()
+
+
+class SyncMirror:
+    # Keeps the last /chip/sync (cards, loans and holds) of an account on disk, and turns every new sync
+    # into a list of what changed since the one before, like
+    # {"type": "loan_added", "id": "123", "cardId": "456", "title": "...", "item": {...the loan...}}.
+    # Types are card_added/removed, loan_added/removed, loan_expiring, hold_added/removed and hold_available.
+    def __init__(self, path_: str = None, expiring_days: float = 3):
+        self.path = path_
+        self.expiring_days = expiring_days
+        self.snapshot = {"cards": {}, "loans": {}, "holds": {}, "expiring": [], "available": []}
+        if path_ and os.path.isfile(path_):
+            with open(path_, "r") as r:
+                self.snapshot.update(json.loads(r.read()))
+
+    def get_key(self, item: dict) -> str:
+        return f"{item.get('cardId')}/{item['id']}"
+
+    def get_event(self, type_: str, item: dict) -> dict:
+        if type_.startswith("card_"):
+            return {"type": type_, "id": item["cardId"], "cardId": item["cardId"], "title": item.get("advantageKey"), "item": item}
+        return {"type": type_, "id": item.get("id"), "cardId": item.get("cardId"), "title": item.get("title"), "item": item}
+
+    def is_expiring(self, loan: dict, now: datetime.datetime) -> bool:
+        if not loan.get("expireDate"):
+            return False
+        expires = datetime.datetime.fromisoformat(loan["expireDate"].replace("Z", "+00:00"))
+        if expires.tzinfo is None:
+            expires = expires.replace(tzinfo=datetime.timezone.utc)
+        return expires - now < datetime.timedelta(days=self.expiring_days)
+
+    def update(self, sync: dict) -> list[dict]:
+        # An error (or a sync that didn't go through) has no cards, loans or holds. That doesn't mean they are
+        # gone, so we keep what we had instead of telling that everything was removed (and added again later).
+        if not isinstance(sync, dict) or sync.get("result") != "synchronized":
+            return []
+        events = []
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cards = {str(c["cardId"]): c for c in sync.get("cards", [])}
+        loans = {self.get_key(l): l for l in sync.get("loans", [])}
+        holds = {self.get_key(h): h for h in sync.get("holds", [])}
+
+        for name, old, new in (("card", self.snapshot["cards"], cards), ("loan", self.snapshot["loans"], loans),
+                               ("hold", self.snapshot["holds"], holds)):
+            events += [self.get_event(f"{name}_added", new[key]) for key in new if key not in old]
+            events += [self.get_event(f"{name}_removed", old[key]) for key in old if key not in new]
+
+        # These are only told once per loan/hold, the lists are what we have already told about
+        expiring = [key for key, loan in loans.items() if self.is_expiring(loan, now)]
+        for key in expiring:
+            if key not in self.snapshot["expiring"]:
+                events.append(self.get_event("loan_expiring", loans[key]))
+        available = [key for key, hold in holds.items() if hold.get("isAvailable")]
+        for key in available:
+            if key not in self.snapshot["available"]:
+                events.append(self.get_event("hold_available", holds[key]))
+
+        self.snapshot = {"cards": cards, "loans": loans, "holds": holds, "expiring": expiring, "available": available}
+        self.save()
+        return events
+
+    def save(self):
+        if self.path:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as w:
+                w.write(json.dumps(self.snapshot, indent=4, sort_keys=True))
+            os.replace(tmp_path, self.path)
+
+
+SENTRY_URL = "https://sentry-read.svc.overdrive.com"
+# API documentation: https://thunder-api.overdrive.com/docs/ui/index
+THUNDER_URL = "https://thunder.api.overdrive.com"
+
+
+class LibbyBase:
+    # Everything that doesn't need a connection: where the endpoints are and how to read the answers.
+    # Libby and AsyncLibby (pylibby_async.py) only add the actual requests on top of this.
+    sentry_url = SENTRY_URL
+    thunder_url = THUNDER_URL
+    # Set to a TitleIndex to have every media info and search hit we get indexed
+    title_index = None
     id_path = None
-    def __init__(self, id_path: str, code: str = None):
+    # A MediaInfoCache, set by Libby and AsyncLibby
+    media_info_cache = None
+    # Largest read when streaming downloads
+    max_chunk_size = 1024 * 1024
+
+    def chip_url(self) -> str:
+        return f"{self.sentry_url}/chip"
+
+    def clone_url(self) -> str:
+        return f"{self.sentry_url}/chip/clone/code"
+
+    def sync_url(self) -> str:
+        return f"{self.sentry_url}/chip/sync"
+
+    def loan_url(self, card_id: str, title_id: str) -> str:
+        return f"{self.sentry_url}/card/{card_id}/loan/{title_id}"
+
+    def fulfill_url(self, card_id: str, title_id: str, format_id: str) -> str:
+        return f"{self.loan_url(card_id, title_id)}/fulfill/{format_id}"
+
+    def open_url(self, loan: dict, card_id: str, title_id: str) -> str:
+        return f"{self.sentry_url}/open/{'audiobook' if loan['type']['id'] == 'audiobook' else 'book'}/card/{card_id}/title/{title_id}"
+
+    def media_url(self, title_id: str) -> str:
+        return f"{self.thunder_url}/v2/media/{title_id}"
+
+    def media_bulk_url(self, title_ids: list[str]) -> str:
+        return f"{self.thunder_url}/v2/media/bulk?titleIds={','.join(title_ids)}"
+
+    def availability_url(self, library: str, title_id: str) -> str:
+        return f"{self.thunder_url}/v2/libraries/{library}/media/{title_id}/availability"
+
+    def search_url(self, libraries: list[str], query: str, media_type: str = None, page: int = None, per_page: int = None) -> str:
+        params = [("libraryKey", library) for library in libraries] + [("query", query)]
+        if media_type:
+            # Lets thunder do the filtering instead of us throwing away most of every page
+            params.append(("mediaTypes", media_type))
+        if page:
+            params += [("page", page), ("perPage", per_page)]
+        return f"{self.thunder_url}/v2/media/search?{urllib.parse.urlencode(params, quote_via=urllib.parse.quote)}"
+
+    def get_missing_media_infos(self, title_ids: list[str], media_infos: dict) -> list[str]:
+        # The ids we have no media info for yet
+        return [title_id for title_id in title_ids if title_id not in media_infos]
+
+    def store_media_infos(self, bulk: list) -> dict[str, dict]:
+        # Remembers what came back from the bulk endpoint in the cache (and title index), returns it keyed by id.
+        # Anything that isn't a media info (like an error) is left out.
+        media_infos = {}
+        if isinstance(bulk, list):
+            for media_info in bulk:
+                if isinstance(media_info, dict) and "id" in media_info:
+                    media_infos[str(media_info["id"])] = media_info
+            self.media_info_cache.put_many(media_infos)
+            if self.title_index is not None:
+                self.title_index.add(list(media_infos.values()))
+        return media_infos
+
+    def get_search_hits(self, response, media_type: str, per_page: int) -> tuple[list, bool]:
+        # Returns the hits on a search page and whether there are more pages after it.
+        # Thunder answers with either a plain list or {"items": [...], "links": {"next": ...}}
+        if isinstance(response, dict):
+            hits = response.get("items", [])
+            more = bool(response.get("links", {}).get("next")) and bool(hits)
+        else:
+            hits = response if isinstance(response, list) else []
+            more = len(hits) >= per_page
+        if media_type:
+            # In case the filter was ignored
+            hits = [h for h in hits if h["type"]["id"] == media_type]
+        if self.title_index is not None:
+            self.title_index.add(hits)
+        return hits, more
+
+    def is_logged_in_by_sync(self, s: dict) -> bool:
+        if "result" in s:
+            if s["result"] == "missing_chip":
+                return False
+            if s["result"] == "synchronized":
+                if "cards" in s:
+                    if s["cards"]:
+                        # at least one card in account means we have to be logged in
+                        return True
+        return False
+
+    def get_loan_by_sync(self, s: dict, title_id: str) -> dict:
+        return next((l for l in s["loans"] if l["id"] == title_id), {})
+
+    def get_borrow_request(self, media_info: dict, days: int) -> dict:
+        return {
+            "period": days,
+            "units": "days",
+            "lucky_day": None,
+            "title_format": media_info["type"]["id"]
+        }
+
+    def get_cards_with_room(self, s: dict) -> list:
+        cards = []
+        for card in s["cards"]:
+            if int(card["counts"]["loan"]) >= int(card["limits"]["loan"]):
+                print(f"Card {card['cardId']} at {card['advantageKey']} is at its limit, skipping.")
+            else:
+                cards.append(card)
+        return cards
+
+    def pick_card_by_copies(self, cards: list, availabilities: list) -> dict:
+        candidates = []
+        for position, (card, availability) in enumerate(zip(cards, availabilities)):
+            if availability.get("isAvailable"):
+                candidates.append((-int(availability.get("availableCopies") or 0), position, card))
+            else:
+                wait = availability.get("estimatedWaitDays")
+                print(f"Book not available at {card['advantageKey']}" + (f", estimated wait is {wait} days." if wait is not None else "."))
+        if candidates:
+            card = min(candidates, key=lambda c: c[:2])[2]
+            print(f"Book available at {card['advantageKey']}.")
+            return card
+        return {}
+
+    def get_web_url_with_message(self, audiobook: dict) -> str:
+        return audiobook["urls"]["web"] + "?" + audiobook["message"]
+
+    def get_spine_parts(self, audiobook_info: dict) -> list[tuple[str, int]]:
+        # Download url and the size openbook says the part has (if it says anything)
+        return [(audiobook_info["audiobook_urls"]["urls"]["web"] + s["path"], s.get("-odread-file-bytes"))
+                for s in audiobook_info["openbook"]["spine"]]
+
+    def get_resume_request(self, manifest: "DownloadManifest", filename: str, download_url: str, tmp_path: str) -> tuple[int, dict]:
+        entry = manifest.get(filename)
+        validator = entry.get("etag") or entry.get("last_modified")
+        offset = 0
+        if validator and entry.get("url") == download_url and os.path.isfile(tmp_path):
+            offset = min(entry.get("completed", 0), os.path.getsize(tmp_path))
+
+        headers = {}
+        if offset:
+            # If-Range makes the server send the whole file if it has changed since last time
+            headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+        return offset, headers
+
+    def get_part_action(self, status: int, size: Optional[int], offset: int, filename: str, headers=None) -> str:
+        # What to do with the answer to get_resume_request: "done" if we already had all of it,
+        # "resume" to continue the .part file from offset, "restart" to write it from the start and
+        # "stale" if the .part file doesn't fit the file on the server (see reset_part)
+        if status == 416 and offset:
+            # The server tells us how big the file is in Content-Range ("bytes */1234")
+            total = (headers or {}).get("Content-Range", "").rpartition("/")[2]
+            if total.isdigit():
+                size = int(total)
+            # Otherwise we had everything, we just didn't get to rename it
+            return "done" if size == offset else "stale"
+        if status == 206:
+            return "resume"
+        if status == 200:
+            return "restart"
+        raise RuntimeError(f"Couldn't download {filename}: HTTP {status}.")
+
+    def restart_part(self, manifest: "DownloadManifest", filename: str, download_url: str, headers,
+                     expected_size: int = None) -> Optional[int]:
+        # The server sends the whole part, forget what we had of it. Returns the size to expect.
+        size = int(headers.get("Content-Length", 0)) or expected_size
+        manifest.update(filename, url=download_url, size=size, completed=0, done=False,
+                        etag=headers.get("ETag"), last_modified=headers.get("Last-Modified"))
+        return size
+
+    def reset_part(self, manifest: "DownloadManifest", filename: str, tmp_path: str):
+        # Forget what we have of a part, the next get_resume_request asks for all of it
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        manifest.update(filename, size=None, completed=0, done=False, etag=None, last_modified=None)
+
+    def finish_part(self, tmp_path: str, file_path: str, filename: str, manifest: "DownloadManifest",
+                    completed: int, size: Optional[int], stages: list = ()) -> str:
+        if size and completed != size:
+            # Keep the .part file, the next run will continue where this one stopped
+            raise RuntimeError(f"Download of {filename} was interrupted, got {completed} of {size} bytes.")
+
+        with open(tmp_path, "r+b") as w:
+            # Space may have been reserved for more than we got
+            w.truncate(completed)
+            results = {}
+            for stage in stages:
+                results.update(stage.finish(w, completed))
+
+        os.replace(tmp_path, file_path)
+        manifest.update(filename, size=os.path.getsize(file_path), completed=completed, done=True, **results)
+        return file_path
+
+    def is_downloaded(self, manifest: "DownloadManifest", final_path: str, save_info=False) -> bool:
+        return manifest.complete and all(manifest.is_done(name, final_path) for name in manifest.data["files"]) \
+            and (not save_info or os.path.isfile(os.path.join(final_path, "info.json")))
+
+    def get_part_stages(self, media_info: dict, track: int, hash_parts=False, tag_parts=False) -> list:
+        # Tagging changes the file, so it has to be done before it is hashed
+        stages = []
+        if tag_parts:
+            stages.append(ID3Stage(media_info, track, self.get_author_by_media_info(media_info)))
+        if hash_parts:
+            stages.append(HashStage())
+        return stages
+
+    def get_bandwidth_limit(self, bandwidth: float = None) -> Optional[TokenBucket]:
+        # Bytes per second for all downloads together, with a small burst so it holds over short periods too
+        return TokenBucket(bandwidth, min(bandwidth, self.max_chunk_size)) if bandwidth is not None else None
+
+    def read_identity(self) -> Optional[dict]:
+        # What get_chip saved in the id file, None if there is no id file yet
+        if not os.path.isfile(self.id_path):
+            return None
+        with open(self.id_path, "r") as r:
+            return json.loads(r.read())
+
+    def write_identity(self, chip: dict):
+        with open(self.id_path, "w") as w:
+            w.write(json.dumps(chip, indent=4, sort_keys=True))
+
+    def get_login_error(self, code=None) -> RuntimeError:
+        # Why login failed, after trying with code (if any)
+        if code:
+            return RuntimeError("Couldn't log in with code, are you sure you wrote it correctly and that "
+                                "you are within the time limit?"
+                                "You need at least 1 registered library card.")
+        if os.path.isfile(self.id_path):
+            return RuntimeError("Not logged in and no code was given.")
+        return RuntimeError("PyLibby needs a path to a JSON-file with ID-info. To get the file you"
+                            " need to provide a code you can get from libby by going to"
+                            " Settings->Copy To Another Device.")
+
+    def get_identity_expiry(self, identity: str) -> Optional[float]:
+        # The identity is a JWT, we only peek at when it expires (no need to check the signature, OverDrive does).
+        # None if it doesn't look like one.
+        try:
+            payload = identity.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return float(claims["exp"])
+        except (IndexError, ValueError, KeyError, TypeError):
+            return None
+
+    def is_identity_stale(self, identity: str, margin: float = 60 * 60) -> bool:
+        expiry = self.get_identity_expiry(identity)
+        return expiry is not None and expiry - margin < time.time()
+
+    def get_index_entry(self, media_info: dict) -> Optional[dict]:
+        # What TitleIndex keeps of a media info, loans and search hits work too. None if it isn't a title.
+        if not isinstance(media_info, dict) or "id" not in media_info or "title" not in media_info:
+            return None
+        if "creators" in media_info:
+            authors = self.get_author_by_media_info(media_info)
+            narrators = self.get_narrator_by_media_info(media_info)
+        else:
+            # Loans only have the first creator
+            authors = media_info.get("firstCreatorName", "")
+            narrators = ""
+        series = media_info.get("detailedSeries", {}).get("seriesName") or media_info.get("series") or ""
+        isbns = {str(i["value"]) for f in media_info.get("formats", []) for i in f.get("identifiers", []) if i.get("type") == "ISBN"}
+        try:
+            languages = self.get_languages_by_media_info(media_info) if "languages" in media_info else ""
+        except KeyError:
+            languages = " ".join(l.get("id", "") for l in media_info["languages"])
+        publisher = media_info.get("publisher", {})
+        return {
+            "id": str(media_info["id"]),
+            "type": media_info.get("type", {}).get("id", ""),
+            "title": media_info["title"] + (f" {media_info['subtitle']}" if media_info.get("subtitle") else ""),
+            "authors": authors,
+            "narrators": narrators,
+            "series": series,
+            "isbn": " ".join(sorted(isbns)),
+            "languages": languages,
+            "publisher": publisher.get("name", "") if isinstance(publisher, dict) else str(publisher),
+        }
+
+    def get_author_by_media_info(self, media_info: dict) -> str:
+        return " and ".join([creator["name"] for creator in media_info["creators"] if creator["role"] == "Author"])
+
+    def get_languages_by_media_info(self, media_info: dict) -> str:
+        return " and ".join([l["Name"] for l in media_info["languages"]])
+
+    def get_narrator_by_media_info(self, media_info: dict) -> str:
+        return " and ".join([creator["name"] for creator in media_info["creators"] if creator["role"] == "Narrator"])
+
+    def get_download_path(self, media_info: dict) -> str:
+        # this should probably take a template, hardcoding the format for now
+        author_path = self.get_author_by_media_info(media_info)
+        book_path = ""
+        if "detailedSeries" in media_info:
+            if "readingOrder" in media_info["detailedSeries"]:
+                book_path += f"{media_info['detailedSeries']['seriesName']}_{media_info['detailedSeries']['readingOrder']}-"
+        book_path += f"{media_info['title']}"
+        if "publishDate" in media_info:
+            book_path +=f"-[{str(datetime.datetime.fromisoformat(media_info['publishDate']).year)}]"
+        book_path += f"-[ODID_{media_info['id']}]"
+        for f in media_info["formats"]:
+            for i in f["identifiers"]:
+                if i["type"] == "ISBN":
+                    book_path += f"-[ISBN_{str(i['value'])}]"
+                    return os.path.join(author_path, book_path).replace(" ", "_")
+
+        return os.path.join(author_path, book_path).replace(" ", "_")
+
+    def get_filename(self, url: str) -> str:
+        url_parsed = urllib.parse.unquote(url)
+        url_parsed = url_parsed.split("#")[0]
+        url_parsed = url_parsed.split("?")[0]
+        url_parsed = url_parsed.split("://")[-1]
+        url_parsed = url_parsed.split("}")[-1]
+        return path.basename(url_parsed)
+
+    def get_formats_for_loaned_book_or_media_info(self, loan: dict) -> list[str]:
+        return [f["id"] for f in loan["formats"]]
+
+
+class Libby(LibbyBase):
+    # Smallest read when streaming downloads, reads grow up to max_chunk_size
+    min_chunk_size = 64 * 1024
+    def __init__(self, id_path: str, code: str = None, pool_size: int = 10, cache: MediaInfoCache = None,
+                 sync_max_age: float = 30, host_limits: dict[str, int] = None,
+                 rate_limits: dict[str, tuple[float, float]] = None, retries: int = 5, stats: Stats = None,
+                 sentry_url: str = None, thunder_url: str = None, assets: AssetStore = None,
+                 title_index: TitleIndex = None, adapter: "LibbyAdapter" = None, verify: bool = True,
+                 bandwidth: float = None):
+        # adapter lets several Libby (one per account) share connections and limits, each still has its own
+        # session and so its own Authorization header. With verify=False we don't sync to check the login,
+        # AccountManager does that when it's needed.
         self.id_path = id_path
+        self.title_index = title_index
+        self.bandwidth_limit = self.get_bandwidth_limit(bandwidth)
+        # Where covers are kept and linked from, without one every book folder gets its own copies
+        self.assets = assets
+        # Only needed to talk to something else than OverDrive, like the stub server in benchmarks/
+        if sentry_url:
+            self.sentry_url = sentry_url
+        if thunder_url:
+            self.thunder_url = thunder_url
+        # Call self.stats.add_hook() to get told about every request, retry and cache lookup
+        self.stats = stats if stats is not None else Stats()
+        # /chip/sync is used by almost everything, reuse the last answer for this many seconds.
+        # Anything that changes loans or cards throws it away.
+        self.sync_max_age = sync_max_age
+        self.sync_snapshot = None
+        self.sync_time = 0.0
+        self.sync_lock = threading.Lock()
+        # Without a cache given we still avoid asking for the same media info twice in one run
+        self.media_info_cache = cache if cache is not None else MediaInfoCache()
+        # Only imported now, so that importing pylibby stays fast
+        import requests
+        from pylibby_transport import LibbyAdapter
+
         self.http_session = requests.Session()
+        if adapter is None:
+            # The default pool only keeps 10 connections per host, size it so parallel downloads can reuse sockets
+            adapter = LibbyAdapter(host_limits, rate_limits, retries=retries, stats=self.stats, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http_session.mount("https://", adapter)
+        self.http_session.mount("http://", adapter)
 
         headers = {
             "Accept": "application/json",
@@ -40,71 +888,72 @@ class Libby:
 
         self.http_session.headers.update(headers)
 
-        if os.path.isfile(id_path):
-            with open(id_path, "r") as r:
-                identity = json.loads(r.read())
+        identity = self.read_identity()
+        if identity is not None:
             self.http_session.headers.update({'Authorization': f'Bearer {identity["identity"]}'})
+            if not verify and not code:
+                return
             if not self.is_logged_in():
-                if code:
-                    self.clone_by_code(code)
-                    if not self.is_logged_in():
-                        raise RuntimeError("Couldn't log in with code, are you sure you wrote it correctly and that "
-                                           "you are within the time limit?"
-                                           "You need at least 1 registered library card.")
-                else:
-                    raise RuntimeError("Not logged in and no code was given.")
+                if not code:
+                    raise self.get_login_error()
+                self.clone_by_code(code)
+                if not self.is_logged_in():
+                    raise self.get_login_error(code)
         elif code:
             self.get_chip()
             self.clone_by_code(code)
-            if self.is_logged_in():
-                #Updating id file
-                self.get_chip()
-            else:
-                raise RuntimeError("Couldn't log in with code, are you sure you wrote it correctly and that "
-                                   "you are within the time limit?"
-                                   "You need at least 1 registered library card.")
-
+            if not self.is_logged_in():
+                raise self.get_login_error(code)
+            #Updating id file
+            self.get_chip()
         else:
-            raise RuntimeError("PyLibby needs a path to a JSON-file with ID-info. To get the file you"
-                               " need to provide a code you can get from libby by going to"
-                               " Settings->Copy To Another Device.")
+            raise self.get_login_error()
 
     def is_logged_in(self) -> bool:
-        s = self.get_sync()
-        if "result" in s:
-            if s["result"] == "missing_chip":
-                return False
-            if s["result"] == "synchronized":
-                if "cards" in s:
-                    if s["cards"]:
-                        # at least one card in account means we have to be logged in
-                        return True
-        return False
+        return self.is_logged_in_by_sync(self.get_sync())
 
-    def borrow_book(self, title_id:str, card_id: str, days: int = 21) -> dict:
-        media_info = self.get_media_info(title_id)
-        j = {
-            "period": days,
-            "units": "days",
-            "lucky_day": None,
-            "title_format": media_info["type"]["id"]
-        }
+    def get_identity(self) -> str:
+        return self.http_session.headers.get("Authorization", "").removeprefix("Bearer ")
 
-        url = f"https://sentry-read.svc.overdrive.com/card/{card_id}/loan/{title_id}"
-        resp = self.http_session.post(url, json=j)
+    def borrow_book(self, title_id:str, card_id: str, days: int = 21) -> dict:
+        j = self.get_borrow_request(self.get_media_info(title_id), days)
+        resp = self.http_session.post(self.loan_url(card_id, title_id), json=j)
+        self.invalidate_sync()
         if resp.status_code != 200:
             raise RuntimeError(f"Couldn't borrow book: {resp.json()}, you may need to verify your card in the app.")
         return resp.json()
 
-    def borrow_book_on_any_logged_in_library(self, title_id:str, days: int = 21) -> dict:
-        for card in self.get_sync()["cards"]:
-            if int(card["counts"]["loan"]) >= int(card["limits"]["loan"]):
-                print(f"Card {card['cardId']} at {card['advantageKey']} is at its limit, skipping.")
-            elif self.is_book_available(card["advantageKey"], title_id):
-                print(f"Book available at {card['advantageKey']}.")
-                return self.borrow_book(title_id, card["cardId"], days)
+    def borrow_book_on_any_logged_in_library(self, title_id:str, days: int = 21, priority: str = "order") -> dict:
+        # priority "order" borrows from the first card (in the order Libby has them) where the book is available,
+        # "copies" checks every card and prefers the library with the most copies available.
+        if priority not in ("order", "copies"):
+            raise ValueError(f"Unknown priority: {priority}")
+
+        cards = self.get_cards_with_room(self.get_sync())
+        if not cards:
+            print("Book not available at any of your libraries.")
+            return {}
+
+        # Imported here, it takes a while and a lot of commands never need threads
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=len(cards))
+        try:
+            futures = [executor.submit(self.get_availability, card["advantageKey"], title_id) for card in cards]
+            if priority == "order":
+                # Results are looked at in card order, so we can borrow as soon as the first available card is
+                # known without waiting for the libraries further down the list.
+                for card, future in zip(cards, futures):
+                    if future.result().get("isAvailable"):
+                        print(f"Book available at {card['advantageKey']}.")
+                        return self.borrow_book(title_id, card["cardId"], days)
+                    print(f"Book not available at {card['advantageKey']}.")
             else:
-                print(f"Book not available at {card['advantageKey']}.")
+                card = self.pick_card_by_copies(cards, [future.result() for future in futures])
+                if card:
+                    return self.borrow_book(title_id, card["cardId"], days)
+        finally:
+            # Don't wait for libraries we no longer care about
+            executor.shutdown(wait=False, cancel_futures=True)
         print("Book not available at any of your libraries.")
         return {}
 
@@ -119,31 +968,106 @@ class Libby:
         if not card_id:
             raise RuntimeError("Couldn't find cardId on loan or couldn't find loan at all, can't return it.")
 
-        url = f"https://sentry-read.svc.overdrive.com/card/{card_id}/loan/{title_id}"
-        resp = self.http_session.delete(url)
+        resp = self.http_session.delete(self.loan_url(card_id, title_id))
+        self.invalidate_sync()
         if resp.status_code != 200:
             raise RuntimeError(f"Couldn't return book: {resp.json()}, you may need to verify your card in the app.")
 
-    def get_sync(self) -> dict:
-        return self.http_session.get("https://sentry-read.svc.overdrive.com/chip/sync").json()
+    def get_sync(self, max_age: float = None) -> dict:
+        if max_age is None:
+            max_age = self.sync_max_age
+        with self.sync_lock:
+            if self.sync_snapshot is not None and time.monotonic() - self.sync_time < max_age:
+                self.stats.record({"type": "cache", "name": "sync", "hit": True})
+                return self.sync_snapshot
+            self.stats.record({"type": "cache", "name": "sync", "hit": False})
+            self.sync_snapshot = self.http_session.get(self.sync_url()).json()
+            self.sync_time = time.monotonic()
+            return self.sync_snapshot
+
+    def invalidate_sync(self):
+        with self.sync_lock:
+            self.sync_snapshot = None
+
+    def watch(self, mirror: SyncMirror, min_interval: float = 60, max_interval: float = 900) -> Iterator[dict]:
+        # Polls /chip/sync forever and yields what changed. Polls every min_interval seconds while things happen,
+        # and backs off towards max_interval when nothing does.
+        # A failed poll (after the adapter has given up retrying) also backs off, and we keep polling.
+        import requests
+
+        interval = min_interval
+        while True:
+            try:
+                sync = self.get_sync(max_age=0)
+            except (requests.RequestException, ValueError):
+                sync = None
+            if sync is None or not self.is_logged_in_by_sync(sync):
+                interval = min(max_interval, interval * 2)
+            else:
+                events = mirror.update(sync)
+                yield from events
+                interval = min_interval if events else min(max_interval, interval * 1.5)
+            time.sleep(interval)
+
+    def get_media_info(self, title_id: str, use_cache: bool = True) -> dict:
+        if use_cache:
+            media_info = self.media_info_cache.get(title_id)
+            self.stats.record({"type": "cache", "name": "media_info", "hit": media_info is not None})
+            if media_info is not None:
+                return media_info
+        media_info = self.http_session.get(self.media_url(title_id)).json()
+        if "id" in media_info:
+            # Errors have no id, those we don't want to remember
+            self.media_info_cache.put(title_id, media_info)
+            if self.title_index is not None:
+                self.title_index.add([media_info])
+        return media_info
+
+    def get_media_infos(self, title_ids: list[str], use_cache: bool = True, bulk_size: int = 50, workers: int = 8) -> dict[str, dict]:
+        # Media info for many titles at once, keyed by title id. Uses the bulk endpoint and falls back to
+        # fetching one by one (concurrently) for anything it didn't return.
+        title_ids = list(dict.fromkeys(str(title_id) for title_id in title_ids))
+        media_infos = {}
+        missing = []
+        for title_id in title_ids:
+            media_info = self.media_info_cache.get(title_id) if use_cache else None
+            if use_cache:
+                self.stats.record({"type": "cache", "name": "media_info", "hit": media_info is not None})
+            if media_info is not None:
+                media_infos[title_id] = media_info
+            else:
+                missing.append(title_id)
+
+        def get_bulk(chunk: list[str]) -> list:
+            resp = self.http_session.get(self.media_bulk_url(chunk))
+            return resp.json() if resp.status_code == 200 else []
+
+        if missing:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                chunks = [missing[i:i + bulk_size] for i in range(0, len(missing), bulk_size)]
+                for bulk in executor.map(get_bulk, chunks):
+                    media_infos.update(self.store_media_infos(bulk))
+                missing = self.get_missing_media_infos(missing, media_infos)
+                for title_id, media_info in zip(missing, executor.map(lambda t: self.get_media_info(t, use_cache=False), missing)):
+                    media_infos[title_id] = media_info
 
-    def get_media_info(self, title_id: str) -> dict:
-        # API documentation: https://thunder-api.overdrive.com/docs/ui/index
-        return self.http_session.get(f"https://thunder.api.overdrive.com/v2/media/{title_id}").json()
+        return {title_id: media_infos[title_id] for title_id in title_ids}
 
     def get_loans(self) -> list:
         return self.get_sync()["loans"]
 
     def get_chip(self) -> dict:
-        response = self.http_session.post("https://sentry-read.svc.overdrive.com/chip", params={"client": "dewey"}).json()
+        response = self.http_session.post(self.chip_url(), params={"client": "dewey"}).json()
         self.http_session.headers.update({'Authorization': f'Bearer {response["identity"]}'})
-        with open(self.id_path, "w") as w:
-            w.write(json.dumps(response, indent=4, sort_keys=True))
+        self.invalidate_sync()
+        self.write_identity(response)
 
         return response
 
     def clone_by_code(self, code: int) -> dict:
-        resp = self.http_session.post("https://sentry-read.svc.overdrive.com/chip/clone/code", data={"code": code})
+        resp = self.http_session.post(self.clone_url(), data={"code": code})
+        self.invalidate_sync()
         self.get_chip()
         return resp.json()
 
@@ -151,26 +1075,21 @@ class Libby:
         return any(l for l in self.get_sync()["loans"] if l["id"] == title_id)
 
     def get_loan(self, title_id: str) -> dict:
-        return next((l for l in self.get_sync()["loans"] if l["id"] == title_id), {})
+        return self.get_loan_by_sync(self.get_sync(), title_id)
 
     def open_audiobook(self, card_id: str, title_id: str) -> dict:
         loan = self.get_loan(title_id)
         if not loan:
             raise RuntimeError("Can't open a book if it is not checked out.")
 
-        url = f"https://sentry-read.svc.overdrive.com/open/{'audiobook' if loan['type']['id'] == 'audiobook' else 'book'}/card/{card_id}/title/{title_id}"
-        audiobook = self.http_session.get(url).json()
-        message = audiobook["message"]
+        audiobook = self.http_session.get(self.open_url(loan, card_id, title_id)).json()
         openbook_url = audiobook["urls"]["openbook"]
 
         #THIS IS IMPORTANT
-        old_headers = self.http_session.headers
-        self.http_session.headers = None
-        #We need this to set a cookie for us
-        web_url_with_message = audiobook["urls"]["web"] + "?" + message
-        self.http_session.get(web_url_with_message)
-
-        self.http_session.headers = old_headers
+        #We need this to set a cookie for us, and it has to be sent without our usual headers.
+        #Headers set to None are left out, which (unlike swapping the session headers) is safe with other threads.
+        self.http_session.get(self.get_web_url_with_message(audiobook),
+                              headers={k: None for k in self.http_session.headers})
 
         return {
                 "audiobook_urls": audiobook,
@@ -178,18 +1097,37 @@ class Libby:
                 "media_info": self.get_media_info(title_id)
                 }
 
-    def search_for_book_in_logged_in_libraries(self, query: str) -> list:
-        # TODO: make this more readable
-        return requests.get(f"https://thunder.api.overdrive.com/v2/media/search?libraryKey={'libraryKey='.join([card['advantageKey'] + '&' for card in self.get_sync()['cards']])}query={query}").json()
+    def iter_search_pages(self, query: str, media_type: str = None, per_page: int = 24, max_pages: int = None) -> Iterator[list]:
+        # Yields one page of hits at a time, the next page is only asked for when the caller wants it
+        libraries = [card["advantageKey"] for card in self.get_sync()["cards"]]
+        page = 1
+        while max_pages is None or page <= max_pages:
+            response = self.http_session.get(self.search_url(libraries, query, media_type, page, per_page)).json()
+            hits, more = self.get_search_hits(response, media_type, per_page)
+            if hits:
+                yield hits
+            if not more:
+                break
+            page += 1
+
+    def iter_search(self, query: str, media_type: str = None, per_page: int = 24, max_pages: int = None) -> Iterator[dict]:
+        for hits in self.iter_search_pages(query, media_type, per_page, max_pages):
+            yield from hits
+
+    def search_for_book_in_logged_in_libraries(self, query: str, max_pages: int = 1) -> list:
+        return list(self.iter_search(query, max_pages=max_pages))
 
-    def search_for_audiobook_in_logged_in_libraries(self, query: str) -> list:
-        return [h for h in self.search_for_book_in_logged_in_libraries(query) if h["type"]["id"] == "audiobook"]
+    def search_for_audiobook_in_logged_in_libraries(self, query: str, max_pages: int = 1) -> list:
+        return list(self.iter_search(query, "audiobook", max_pages=max_pages))
 
-    def search_for_ebook_in_logged_in_libraries(self, query: str) -> list:
-        return [h for h in self.search_for_book_in_logged_in_libraries(query) if h["type"]["id"] == "ebook"]
+    def search_for_ebook_in_logged_in_libraries(self, query: str, max_pages: int = 1) -> list:
+        return list(self.iter_search(query, "ebook", max_pages=max_pages))
+
+    def get_availability(self, library: str, title_id: str) -> dict:
+        return self.http_session.get(self.availability_url(library, title_id)).json()
 
     def is_book_available(self, library: str, title_id: str) -> bool:
-        availability = requests.get(f"https://thunder.api.overdrive.com/v2/libraries/{library}/media/{title_id}/availability").json()
+        availability = self.get_availability(library, title_id)
         if "isAvailable" in availability:
             return availability["isAvailable"]
         return False
@@ -197,99 +1135,195 @@ class Libby:
     def get_author(self, title_id: str) -> str:
         return " and ".join([creator["name"] for creator in self.get_media_info(title_id)["creators"] if creator["role"] == "Author"])
 
-    def get_author_by_media_info(self, media_info: dict) -> str:
-        return " and ".join([creator["name"] for creator in media_info["creators"] if creator["role"] == "Author"])
-
-    def get_languages_by_media_info(self, media_info: dict) -> str:
-        return " and ".join([l["Name"] for l in media_info["languages"]])
-
     def get_narrator(self, title_id: str) -> str:
         media_info = self.get_media_info(title_id)
         return " and ".join([creator["name"] for creator in media_info["creators"] if creator["role"] == "Narrator"])
 
-    def get_narrator_by_media_info(self, media_info: dict) -> str:
-        return " and ".join([creator["name"] for creator in media_info["creators"] if creator["role"] == "Narrator"])
-
-    def get_download_path(self, media_info: dict) -> str:
-        # this should probably take a template, hardcoding the format for now
-        author_path = self.get_author_by_media_info(media_info)
-        book_path = ""
-        if "detailedSeries" in media_info:
-            if "readingOrder" in media_info["detailedSeries"]:
-                book_path += f"{media_info['detailedSeries']['seriesName']}_{media_info['detailedSeries']['readingOrder']}-"
-        book_path += f"{media_info['title']}"
-        if "publishDate" in media_info:
-            book_path +=f"-[{str(datetime.datetime.fromisoformat(media_info['publishDate']).year)}]"
-        book_path += f"-[ODID_{media_info['id']}]"
-        for f in media_info["formats"]:
-            for i in f["identifiers"]:
-                if i["type"] == "ISBN":
-                    book_path += f"-[ISBN_{str(i['value'])}]"
-                    return os.path.join(author_path, book_path).replace(" ", "_")
-
-        return os.path.join(author_path, book_path).replace(" ", "_")
-
     def download_audiobook_mp3(self, loan: dict, output_path: str,
                                callback_functions: list[Callable[[str, int], None]] = None,
-                               save_info=False, download_covers=True):
-        # Workaround for getting audiobook without ODM
-        audiobook_info = self.open_audiobook(loan["cardId"], loan["id"])
+                               save_info=False, download_covers=True, workers: int = 4, hash_parts=False, tag_parts=False):
         if not os.path.exists(output_path):
             raise RuntimeError(f"Path does not exist: {output_path}")
 
-        final_path = os.path.join(output_path, self.get_download_path(audiobook_info["media_info"]))
+        final_path = os.path.join(output_path, self.get_download_path(self.get_media_info(loan["id"])))
         os.makedirs(final_path, exist_ok=True)
+        manifest = DownloadManifest(final_path)
 
-        for download_url in \
-                [audiobook_info["audiobook_urls"]["urls"]["web"] + s["path"] for s in audiobook_info["openbook"]["spine"]]:
-            resp = self.http_session.get(download_url, timeout=10, stream=True)
-
-            filename = self.get_filename(download_url)
-            with open(os.path.join(final_path, filename), "wb") as w:
-                downloaded = 0
-                mb = 0
-                for chunk in resp.iter_content(1024):
-                    w.write(chunk)
-                    downloaded += 1024
-                    if downloaded > 1024 * 1000:
-                        mb += 1
-                        downloaded = 0
-                        if callback_functions:
-                            for f in callback_functions:
-                                f(filename, mb)
-                        else:
-                            print(f"{filename}: Downloaded {mb}MB.")
+        if self.is_downloaded(manifest, final_path, save_info):
+            print(f"Already downloaded to {final_path}.")
+            return
+
+        # Workaround for getting audiobook without ODM
+        audiobook_info = self.open_audiobook(loan["cardId"], loan["id"])
+
+        progress_lock = threading.Lock()
+
+        def report(filename: str, mb: int):
+            # Callbacks are called from the worker threads, only let one through at a time
+            with progress_lock:
+                if callback_functions:
+                    for f in callback_functions:
+                        f(filename, mb)
+                else:
+                    print(f"{filename}: Downloaded {mb}MB.")
+
+        manifest.set_complete(False)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(self.download_part, url, final_path, report, manifest, size,
+                                       self.get_part_stages(audiobook_info["media_info"], track, hash_parts, tag_parts))
+                       for track, (url, size) in enumerate(self.get_spine_parts(audiobook_info), 1)]
+            # result() re-raises the first exception from a worker
+            for future in futures:
+                future.result()
 
         if save_info:
             with open(os.path.join(final_path, "info.json"), "w") as w:
                 w.write(json.dumps(audiobook_info, indent=4))
+        if self.title_index is not None:
+            self.title_index.add([audiobook_info["media_info"]], final_path)
 
         if download_covers:
-            self.download_covers(loan, final_path)
-
-    def get_filename(self, url: str) -> str:
-        url_parsed = urllib.parse.unquote(url)
-        url_parsed = url_parsed.split("#")[0]
-        url_parsed = url_parsed.split("?")[0]
-        url_parsed = url_parsed.split("://")[-1]
-        url_parsed = url_parsed.split("}")[-1]
-        return path.basename(url_parsed)
+            self.download_covers(loan, final_path, manifest)
+
+        manifest.set_complete()
+
+    def download_part(self, download_url: str, final_path: str, callback: Callable[[str, int], None],
+                      manifest: DownloadManifest = None, expected_size: int = None, stages: list = None) -> str:
+        # stages are things like HashStage and ID3Stage, they see the data as it is downloaded
+        filename = self.get_filename(download_url)
+        file_path = os.path.join(final_path, filename)
+        stages = stages or []
+        if manifest is None:
+            manifest = DownloadManifest(final_path)
+        if manifest.is_done(filename, final_path):
+            return file_path
+
+        # Write to a temporary file and rename it when done, so a half written part never looks finished
+        tmp_path = file_path + ".part"
+        while True:
+            offset, headers = self.get_resume_request(manifest, filename, download_url, tmp_path)
+            with self.http_session.get(download_url, headers=headers, timeout=10, stream=True) as resp:
+                size = manifest.get(filename).get("size")
+                action = self.get_part_action(resp.status_code, size, offset, filename, resp.headers)
+                if action == "stale":
+                    # Like a .part of an older, bigger version of the file. Start over, without a Range header
+                    # this can't happen again.
+                    self.reset_part(manifest, filename, tmp_path)
+                    continue
+                if action == "done":
+                    for stage in stages:
+                        stage.start(tmp_path, offset)
+                    completed = offset
+                else:
+                    if action == "restart":
+                        size = self.restart_part(manifest, filename, download_url, resp.headers, expected_size)
+                        offset = 0
+                    completed = self.write_part(resp, tmp_path, offset, filename, manifest, callback, size, stages)
+
+            return self.finish_part(tmp_path, file_path, filename, manifest, completed, size, stages)
+
+    def write_part(self, resp, tmp_path: str, offset: int, filename: str, manifest: DownloadManifest,
+                   callback: Callable[[str, int], None], size: int = None, stages: list = ()) -> int:
+        writer = PartWriter(tmp_path, offset, filename, manifest, callback, size, stages)
+        try:
+            self.copy_stream(resp, writer.file, writer.progress)
+        finally:
+            writer.close()
+            self.stats.record({"type": "bytes", "endpoint": self.stats.get_endpoint("GET", resp.url),
+                               "bytes": writer.completed - offset})
+        return writer.completed
+
+    def copy_stream(self, resp, w, progress: Callable[[int, memoryview], None] = None) -> int:
+        # Reads the body into one reused buffer and writes slices of it, instead of making a new bytes object
+        # for every little chunk. Reads start small and grow while the data keeps coming.
+        if resp.headers.get("Content-Encoding", "identity") != "identity":
+            resp.raw.decode_content = True
+        buffer = memoryview(bytearray(self.max_chunk_size))
+        chunk_size = self.min_chunk_size
+        total = 0
+        while True:
+            n = resp.raw.readinto(buffer[:chunk_size])
+            if not n:
+                break
+            w.write(buffer[:n])
+            total += n
+            if self.bandwidth_limit is not None:
+                self.bandwidth_limit.acquire(n)
+            if progress:
+                progress(n, buffer[:n])
+            if n == chunk_size and chunk_size < self.max_chunk_size:
+                chunk_size *= 2
+        return total
+
+    def download_file(self, url: str, file_path: str, headers: dict = None):
+        # Streams a whole file to disk (through a .part file), returns the response so the caller can look at
+        # status and headers. Nothing is written unless the status is 200.
+        with self.http_session.get(url, headers=headers, stream=True) as resp:
+            if resp.status_code == 200:
+                tmp_path = file_path + ".part"
+                with open(tmp_path, "wb") as w:
+                    n = self.copy_stream(resp, w)
+                os.replace(tmp_path, file_path)
+                self.stats.record({"type": "bytes", "endpoint": self.stats.get_endpoint("GET", url), "bytes": n})
+            return resp
 
     def get_formats(self, title_id: str) -> list[str]:
         # Can return formats that are not available on loan, I'm guessing different libraries have different formats
         info = self.get_media_info(title_id)
         return [f["id"] for f in info["formats"]]
 
-    def get_formats_for_loaned_book_or_media_info(self, loan: dict) -> list[str]:
-        return [f["id"] for f in loan["formats"]]
-
-    def download_covers(self, media_info: dict, path_: str):
+    def download_covers(self, media_info: dict, path_: str, manifest: DownloadManifest = None):
         if "covers" in media_info:
+            if manifest is None:
+                manifest = DownloadManifest(path_)
             for c in media_info["covers"].keys():
-                with open(os.path.join(path_, c + ".jpg"), "wb") as w:
-                    w.write(self.http_session.get(media_info["covers"][c]["href"]).content)
-
-    def download_loan(self, loan: dict, format_id: str, output_path: str, save_info=False, download=True, download_covers=True, get_odm=False):
+                filename = c + ".jpg"
+                href = media_info["covers"][c]["href"]
+                if manifest.is_done(filename, path_) and manifest.get(filename).get("url") == href:
+                    continue
+                file_path = os.path.join(path_, filename)
+                if self.assets is not None:
+                    sha256 = self.download_asset(href)
+                    if sha256 is None:
+                        print(f"Couldn't download cover {filename}.")
+                        continue
+                    self.assets.link(sha256, file_path)
+                    entry = self.assets.get(href)
+                    manifest.update(filename, url=href, size=entry["size"], completed=entry["size"], done=True,
+                                    etag=entry["etag"], last_modified=entry["last_modified"], sha256=sha256)
+                    continue
+                resp = self.download_file(href, file_path)
+                if resp.status_code != 200:
+                    print(f"Couldn't download cover {filename}: HTTP {resp.status_code}.")
+                    continue
+                size = os.path.getsize(file_path)
+                manifest.update(filename, url=href, size=size, completed=size, done=True,
+                                etag=resp.headers.get("ETag"), last_modified=resp.headers.get("Last-Modified"))
+
+    def download_asset(self, href: str) -> Optional[str]:
+        # Gets a file into the asset store, asking the server if what we have is still current.
+        # Returns the hash of the file in the store, or None if it couldn't be had.
+        entry = self.assets.get(href)
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        elif entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        tmp_path = self.assets.get_tmp_path()
+        try:
+            resp = self.download_file(href, tmp_path, headers=headers)
+            if resp.status_code == 304 and entry:
+                return entry["sha256"]
+            if resp.status_code != 200:
+                return None
+            return self.assets.add(tmp_path, href, resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def download_loan(self, loan: dict, format_id: str, output_path: str, save_info=False, download=True, download_covers=True, get_odm=False, workers: int = 4,
+                      hash_parts=False, tag_parts=False):
         # Does not actually download ebook, only gets the ODM or ACSM for now.
         # Will however download audiobook-mp3, without ODM
         if not os.path.exists(output_path):
@@ -297,7 +1331,7 @@ class Libby:
 
         format_is_available = any(f for f in loan["formats"] if f["id"] == format_id)
         if format_is_available:
-            url = f"https://sentry-read.svc.overdrive.com/card/{loan['cardId']}/loan/{loan['id']}/fulfill/{format_id}"
+            url = self.fulfill_url(loan["cardId"], loan["id"], format_id)
             if format_id == "audiobook-mp3":
                 if get_odm:
                     download_path = self.get_download_path(self.get_media_info(loan["id"]))
@@ -307,13 +1341,14 @@ class Libby:
                     fulfill = self.http_session.get(url).json()
                     if "fulfill" in fulfill:
                         fulfill_url = fulfill["fulfill"]["href"]
-                        with open(os.path.join(final_path, loan["id"] + ".odm"), "wb") as w:
-                            w.write(self.http_session.get(fulfill_url).content)
-                            print(f"Downloaded odm file to {w.name}.")
+                        odm_path = os.path.join(final_path, loan["id"] + ".odm")
+                        self.download_file(fulfill_url, odm_path).raise_for_status()
+                        print(f"Downloaded odm file to {odm_path}.")
                     else:
                         raise RuntimeError(f"Something went wrong when downloading odm: {fulfill}")
                 else:
-                    self.download_audiobook_mp3(loan, output_path, save_info=save_info)
+                    self.download_audiobook_mp3(loan, output_path, save_info=save_info, workers=workers,
+                                                hash_parts=hash_parts, tag_parts=tag_parts)
             else:
                 #resp = self.http_session.get(url)
                 #print(resp)
@@ -336,9 +1371,9 @@ class Libby:
                     elif format_id == "ebook-epub-adobe":
                         print("Will download acsm file, use a tool like Knock (https://github.com/agschaid/knock) to get your book.")
                         if download:
-                            with open(os.path.join(final_path, self.get_filename(fulfill_url)), "wb") as w:
-                                w.write(self.http_session.get(fulfill_url).content)
-                                print(f"Downloaded acsm file to {w.name}.")
+                            acsm_path = os.path.join(final_path, self.get_filename(fulfill_url))
+                            self.download_file(fulfill_url, acsm_path).raise_for_status()
+                            print(f"Downloaded acsm file to {acsm_path}.")
                         else:
                             print(fulfill_url)
                     else:
@@ -347,6 +1382,8 @@ class Libby:
                     if save_info:
                         with open(os.path.join(final_path, "loan.json"), "w") as w:
                             w.write(json.dumps(loan, indent=4))
+                    if self.title_index is not None and (download or save_info):
+                        self.title_index.add([self.get_media_info(loan["id"])], final_path)
 
                     if download_covers:
                         self.download_covers(loan, final_path)
@@ -359,6 +1396,513 @@ class Libby:
         else:
             raise RuntimeError(f"Format {format_id} not available for title {loan['id']}. Available formats: {str([f['id'] for f in loan['formats']])}.")
 
+    def run_jobs(self, jobs: list[dict], output_path: str = ".", workers: int = 4, part_workers: int = 4,
+                 save_info=False, get_odm=False, priority: str = "order", hash_parts=False, tag_parts=False) -> list[dict]:
+        # Runs borrow/download/return jobs (see load_jobs). Jobs for the same title run in the order they are
+        # listed, different titles run at the same time. Returns one result per unique job, plus a "prefetch" one
+        # if getting the media info up front failed.
+        unique_jobs = []
+        seen = set()
+        for job in jobs:
+            key = (job["op"], job["id"], job.get("format"))
+            if key not in seen:
+                seen.add(key)
+                unique_jobs.append(job)
+
+        by_title = {}
+        for job in unique_jobs:
+            by_title.setdefault(job["id"], []).append(job)
+
+        def run_title(title_jobs: list[dict]) -> list[dict]:
+            results = []
+            for job in title_jobs:
+                result = {"op": job["op"], "id": job["id"], "format": job.get("format")}
+                start = time.monotonic()
+                try:
+                    if job["op"] == "borrow":
+                        loan = self.borrow_book_on_any_logged_in_library(job["id"], int(job.get("days") or 21), priority)
+                        if not loan:
+                            raise RuntimeError("Book not available at any of your libraries.")
+                        result["result"] = loan
+                    elif job["op"] == "download":
+                        if not job.get("format"):
+                            raise RuntimeError("Download job without a format.")
+                        loan = self.get_loan(job["id"])
+                        if not loan:
+                            raise RuntimeError("Can't download a book that is not checked out.")
+                        result["result"] = self.download_loan(loan, job["format"], output_path, save_info,
+                                                              get_odm=get_odm, workers=part_workers,
+                                                              hash_parts=hash_parts, tag_parts=tag_parts)
+                    elif job["op"] == "return":
+                        self.return_book(job["id"])
+                    else:
+                        raise RuntimeError(f"Unknown operation: {job['op']}")
+                    result["status"] = "ok"
+                except Exception as e:
+                    result["status"] = "error"
+                    result["error"] = str(e)
+                result["seconds"] = round(time.monotonic() - start, 3)
+                results.append(result)
+            return results
+
+        # Downloads need media info, get all of it in one go up front. If that fails every download
+        # just looks up its own, so the failure is only reported.
+        prefetch_results = []
+        download_ids = list(dict.fromkeys(job["id"] for job in unique_jobs if job["op"] == "download"))
+        if download_ids:
+            start = time.monotonic()
+            try:
+                self.get_media_infos(download_ids)
+            except Exception as e:
+                prefetch_results.append({"op": "prefetch", "id": ",".join(download_ids), "format": None,
+                                         "status": "error", "error": str(e),
+                                         "seconds": round(time.monotonic() - start, 3)})
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            title_results = list(executor.map(run_title, by_title.values()))
+
+        return prefetch_results + [result for results in title_results for result in results]
+
+
+class AccountManager:
+    # Many accounts (id files) in one process. They share one LibbyAdapter, so one connection pool and the same
+    # host and rate limits, while each Libby keeps its own session and identity. Accounts are only created and
+    # checked when first asked for, the check (a sync) is remembered in validation_path for validation_ttl
+    # seconds, and a chip is only renewed when its identity is about to expire.
+    def __init__(self, id_paths: list[str], validation_path: str = None, validation_ttl: float = 6 * 60 * 60,
+                 refresh_margin: float = 60 * 60, pool_size: int = 10, host_limits: dict[str, int] = None,
+                 rate_limits: dict[str, tuple[float, float]] = None, retries: int = 5, stats: Stats = None,
+                 cache: MediaInfoCache = None, **kwargs):
+        self.id_paths = list(dict.fromkeys(id_paths))
+        self.validation_path = validation_path
+        self.validation_ttl = validation_ttl
+        self.refresh_margin = refresh_margin
+        self.stats = stats if stats is not None else Stats()
+        self.cache = cache if cache is not None else MediaInfoCache()
+        from pylibby_transport import LibbyAdapter
+
+        self.adapter = LibbyAdapter(host_limits, rate_limits, retries=retries, stats=self.stats,
+                                    pool_connections=pool_size, pool_maxsize=pool_size)
+        # Anything else Libby takes, like sentry_url or title_index
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.account_locks = {}
+        self.accounts = {}
+        self.validations = {}
+        if validation_path and os.path.isfile(validation_path):
+            try:
+                with open(validation_path, "r") as r:
+                    self.validations = json.loads(r.read())
+            except ValueError:
+                pass
+
+    @classmethod
+    def from_folder(cls, folder: str, **kwargs) -> "AccountManager":
+        # Every .json file in folder that has an identity in it, the folder can also have validation.json,
+        # sync_mirror.json and the like in it
+        return cls([path_ for path_ in sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".json"))
+                    if cls.is_id_file(path_)], **kwargs)
+
+    @staticmethod
+    def is_id_file(path_: str) -> bool:
+        try:
+            with open(path_, "r") as r:
+                data = json.loads(r.read())
+        except (OSError, ValueError):
+            return False
+        return isinstance(data, dict) and "identity" in data
+
+    def get(self, id_path: str) -> Libby:
+        with self.lock:
+            account_lock = self.account_locks.setdefault(id_path, threading.Lock())
+        with account_lock:
+            libby = self.accounts.get(id_path)
+            if libby is None:
+                libby = Libby(id_path, cache=self.cache, stats=self.stats, adapter=self.adapter, verify=False, **self.kwargs)
+                self.accounts[id_path] = libby
+            self.validate(id_path, libby)
+        return libby
+
+    def validate(self, id_path: str, libby: Libby):
+        if libby.is_identity_stale(libby.get_identity(), self.refresh_margin):
+            libby.get_chip()
+        key = hashlib.sha256(libby.get_identity().encode()).hexdigest()
+        with self.lock:
+            validation = self.validations.get(id_path, {})
+        if validation.get("identity") == key and time.time() - validation.get("time", 0) < self.validation_ttl:
+            return
+        if not libby.is_logged_in():
+            raise RuntimeError(f"Not logged in with {id_path}, it needs a new code.")
+        with self.lock:
+            # The identity is never written here, only its hash
+            self.validations[id_path] = {"identity": key, "time": time.time()}
+            if self.validation_path:
+                tmp_path = self.validation_path + ".tmp"
+                with open(tmp_path, "w") as w:
+                    w.write(json.dumps(self.validations, indent=4, sort_keys=True))
+                os.replace(tmp_path, self.validation_path)
+
+    def invalidate(self, id_path: str):
+        # Makes the next get() check the login again, e.g. after a request was refused
+        with self.lock:
+            self.validations.pop(id_path, None)
+
+    def __iter__(self) -> Iterator[tuple[str, Libby]]:
+        for id_path in self.id_paths:
+            yield id_path, self.get(id_path)
+
+    def map(self, function: Callable[[Libby], object], workers: int = 8) -> dict[str, object]:
+        # Runs function for every account at the same time, returns the results (or exceptions) by id file
+        def run(id_path: str):
+            try:
+                return function(self.get(id_path))
+            except Exception as e:
+                return e
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            return dict(zip(self.id_paths, executor.map(run, self.id_paths)))
+
+
+class DownloadQueue:
+    # Downloads for many loans, kept in a JSON file so the queue survives between runs (a nightly job can just add
+    # to it and run it). Every book is split into its files (mp3 parts, ODM or ACSM, covers) and files from
+    # several books are downloaded at the same time:
+    # - books with a higher priority go first, then the ones whose loan expires first (as the sync says),
+    # - at most workers files at once, and at most host_limits[host] from one host,
+    # - all of it together stays under Libby(bandwidth=...),
+    # - a book is only started when its files fit on the disk, next to what the started books still need,
+    #   and min_free bytes are left.
+    # Books that fail stay in the queue and are tried again on the next run, resuming what they got.
+    def __init__(self, libby: "Libby", path_: str = None, workers: int = 8, host_limits: dict[str, int] = None,
+                 min_free: int = 100 * 1000 * 1000):
+        self.libby = libby
+        self.path = path_
+        self.workers = workers
+        self.host_limits = dict(host_limits or {})
+        for host, n in self.host_limits.items():
+            # With 0 nothing from the host would ever be started
+            if not n >= 1:
+                raise ValueError(f"Host limit for {host} must be at least 1, got {n}.")
+        self.min_free = min_free
+        self.changed = threading.Condition()
+        self.progress_lock = threading.Lock()
+        self.data = {"books": {}}
+        if path_ and os.path.isfile(path_):
+            # Unlike a broken manifest this can't just be started over, it may be all that is left of what was queued
+            try:
+                with open(path_, "r") as r:
+                    data = json.loads(r.read())
+            except (OSError, ValueError) as e:
+                raise RuntimeError(f"Couldn't read the download queue {path_}: {e}. Fix or remove it.")
+            if not isinstance(data, dict) or not isinstance(data.get("books", {}), dict):
+                raise RuntimeError(f"Couldn't read the download queue {path_}: not a download queue. Fix or remove it.")
+            self.data.update(data)
+        # Only used while running
+        self.pending = []
+        self.ready = []
+        self.active = {}
+        self.running = 0
+        self.preparing = 0
+        self.host_counts = {}
+        self.results = {}
+        self.loans = {}
+        self.callback = None
+
+    def get_key(self, title_id: str, format_id: str) -> str:
+        return f"{title_id}/{format_id}"
+
+    def add(self, loan: dict, format_id: str, output_path: str = ".", priority: int = 0, get_odm=False,
+            save_info=False, hash_parts=False, tag_parts=False) -> str:
+        if not any(f["id"] == format_id for f in loan["formats"]):
+            raise RuntimeError(f"Format {format_id} not available for title {loan['id']}. Available formats: {str([f['id'] for f in loan['formats']])}.")
+        if not os.path.exists(output_path):
+            raise RuntimeError(f"Path does not exist: {output_path}")
+        key = self.get_key(loan["id"], format_id)
+        with self.changed:
+            self.data["books"][key] = {
+                "id": loan["id"], "cardId": loan["cardId"], "title": loan.get("title"), "format": format_id,
+                "output_path": os.path.abspath(output_path), "priority": priority, "expires": loan.get("expireDate"),
+                "get_odm": get_odm, "save_info": save_info, "hash_parts": hash_parts, "tag_parts": tag_parts,
+                "status": "queued", "added": self.data["books"].get(key, {}).get("added", time.time()),
+            }
+            self._save()
+        return key
+
+    def add_loans(self, loans: list[dict], output_path: str = ".", priority: int = 0, **kwargs) -> list[str]:
+        # Every loan in the format we can download best, loans we can't download anything for are left out and
+        # books that are already in the queue (or done) are left as they are
+        keys = []
+        for loan in loans:
+            formats = [f["id"] for f in loan["formats"]]
+            format_id = next((f for f in ("audiobook-mp3", "ebook-epub-adobe") if f in formats), None)
+            if format_id and self.get_key(loan["id"], format_id) not in self.data["books"]:
+                keys.append(self.add(loan, format_id, output_path, priority, **kwargs))
+        return keys
+
+    def remove(self, key: str):
+        with self.changed:
+            self.data["books"].pop(key, None)
+            self._save()
+
+    def clear_done(self):
+        with self.changed:
+            self.data["books"] = {k: b for k, b in self.data["books"].items() if b["status"] != "done"}
+            self._save()
+
+    def get_order(self, book: dict) -> tuple:
+        expires = float("inf")
+        if book.get("expires"):
+            expires = datetime.datetime.fromisoformat(book["expires"].replace("Z", "+00:00")).timestamp()
+        return -book["priority"], expires, book["added"]
+
+    def get_books(self) -> list[dict]:
+        # In the order they will be downloaded
+        with self.changed:
+            return sorted((dict(b, key=k) for k, b in self.data["books"].items()), key=self.get_order)
+
+    def run(self, callback: Callable[[str, int], None] = None) -> list[dict]:
+        # Downloads everything that isn't done, returns one result per book like run_jobs does
+        loans = {loan["id"]: loan for loan in self.libby.get_loans()}
+        results = {}
+        with self.changed:
+            self.pending = []
+            for key, book in self.data["books"].items():
+                if book["status"] == "done":
+                    continue
+                loan = loans.get(book["id"])
+                if loan is None:
+                    book.update(status="error", error="Not checked out anymore.")
+                    results[key] = {"id": book["id"], "format": book["format"], "status": "error", "error": book["error"], "seconds": 0}
+                    continue
+                # The sync knows best when it expires and which card it is on
+                book.update(cardId=loan["cardId"], expires=loan.get("expireDate"), status="queued")
+                book.pop("error", None)
+                self.pending.append(key)
+            self.pending.sort(key=lambda k: self.get_order(self.data["books"][k]))
+            self.ready, self.active, self.running, self.preparing, self.host_counts = [], {}, 0, 0, {}
+            self.results = results
+            self.loans = loans
+            self.callback = callback
+            self._save()
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            for future in [executor.submit(self.work) for _ in range(max(1, self.workers))]:
+                future.result()
+        return list(results.values())
+
+    def work(self):
+        while True:
+            with self.changed:
+                while True:
+                    job = self.next_file()
+                    key = None
+                    if job is None and not self.ready and self.pending:
+                        # Nothing left to do for the books we have started, so start the next one
+                        key = self.pending.pop(0)
+                        self.preparing += 1
+                    if job or key:
+                        break
+                    if not self.ready and not self.pending and not self.running and not self.preparing:
+                        self.changed.notify_all()
+                        return
+                    self.changed.wait()
+            if job:
+                self.run_file(job)
+            else:
+                self.start_book(key)
+
+    def next_file(self) -> Optional[dict]:
+        # The first file (books in order) whose host isn't busy, called with the lock held
+        for i, job in enumerate(self.ready):
+            if self.host_counts.get(job["host"], 0) < self.host_limits.get(job["host"], self.workers):
+                del self.ready[i]
+                self.host_counts[job["host"]] = self.host_counts.get(job["host"], 0) + 1
+                self.running += 1
+                return job
+        return None
+
+    def start_book(self, key: str):
+        book = self.data["books"][key]
+        try:
+            jobs, state = self.plan(key, book)
+            needed = sum(job["bytes"] for job in jobs)
+            free = shutil.disk_usage(state["final_path"]).free
+            with self.changed:
+                reserved = sum(a["bytes"] for a in self.active.values())
+                if needed + reserved + self.min_free > free:
+                    raise RuntimeError(f"Not enough disk space, needs {needed // 1000000} MB and "
+                                       f"{max(0, free - reserved - self.min_free) // 1000000} MB can be used.")
+                state.update(remaining=len(jobs), bytes=needed, errors=[])
+                self.active[key] = state
+                self.ready.extend(jobs)
+                book["status"] = "running"
+                self._save()
+            if not jobs:
+                self.finish_book(key)
+        except Exception as e:
+            self.set_result(key, error=str(e))
+        finally:
+            with self.changed:
+                self.preparing -= 1
+                self.changed.notify_all()
+
+    def plan(self, key: str, book: dict) -> tuple[list[dict], dict]:
+        # What has to be downloaded for a book (that isn't already), and what finish_book needs afterwards.
+        # "bytes" is how much disk a job still needs, what is already in a .part file that will be resumed isn't
+        # counted again.
+        libby = self.libby
+        loan = self.loans[book["id"]]
+        media_info = libby.get_media_info(book["id"])
+        final_path = os.path.join(book["output_path"], libby.get_download_path(media_info))
+        os.makedirs(final_path, exist_ok=True)
+        state = {"start": time.monotonic(), "final_path": final_path, "manifest": DownloadManifest(final_path),
+                 "loan": loan, "media_info": media_info}
+        jobs = []
+        if book["format"] == "audiobook-mp3" and not book["get_odm"]:
+            state["audiobook_info"] = libby.open_audiobook(book["cardId"], book["id"])
+            state["manifest"].set_complete(False)
+            for track, (url, size) in enumerate(libby.get_spine_parts(state["audiobook_info"]), 1):
+                filename = libby.get_filename(url)
+                if not state["manifest"].is_done(filename, final_path):
+                    offset = libby.get_resume_request(state["manifest"], filename, url,
+                                                      os.path.join(final_path, filename) + ".part")[0]
+                    jobs.append({"kind": "part", "url": url, "size": size or 0, "bytes": max(0, (size or 0) - offset),
+                                 "track": track})
+        elif book["format"] in ("audiobook-mp3", "ebook-epub-adobe"):
+            fulfill = libby.http_session.get(libby.fulfill_url(book["cardId"], book["id"], book["format"])).json()
+            if "fulfill" not in fulfill:
+                raise RuntimeError(f"Something went wrong: {fulfill}")
+            url = fulfill["fulfill"]["href"]
+            name = book["id"] + ".odm" if book["format"] == "audiobook-mp3" else libby.get_filename(url)
+            jobs.append({"kind": "file", "url": url, "size": 0, "name": name})
+        else:
+            raise RuntimeError(f"Format {book['format']} can't be queued, only audiobook-mp3 and ebook-epub-adobe.")
+        if loan.get("covers"):
+            jobs.append({"kind": "covers", "url": next(iter(loan["covers"].values()))["href"], "size": 0})
+        for job in jobs:
+            job.setdefault("bytes", job["size"])
+            job.update(key=key, host=urllib.parse.urlsplit(job["url"]).hostname)
+        return jobs, state
+
+    def run_file(self, job: dict):
+        state = self.active[job["key"]]
+        book = self.data["books"][job["key"]]
+        error = None
+        try:
+            if job["kind"] == "part":
+                media_info = state["audiobook_info"]["media_info"]
+                self.libby.download_part(job["url"], state["final_path"], self.report, state["manifest"], job["size"] or None,
+                                         self.libby.get_part_stages(media_info, job["track"], book["hash_parts"], book["tag_parts"]))
+            elif job["kind"] == "file":
+                file_path = os.path.join(state["final_path"], job["name"])
+                self.libby.download_file(job["url"], file_path).raise_for_status()
+                print(f"Downloaded {job['name']} to {file_path}.")
+            else:
+                self.libby.download_covers(state["loan"], state["final_path"], state["manifest"])
+        except Exception as e:
+            error = str(e)
+        with self.changed:
+            self.running -= 1
+            self.host_counts[job["host"]] -= 1
+            state["remaining"] -= 1
+            state["bytes"] -= job["bytes"]
+            if error:
+                state["errors"].append(error)
+            done = state["remaining"] == 0
+            self.changed.notify_all()
+        if done:
+            self.finish_book(job["key"])
+
+    def finish_book(self, key: str):
+        state = self.active[key]
+        book = self.data["books"][key]
+        try:
+            if state["errors"]:
+                raise RuntimeError(state["errors"][0])
+            if "audiobook_info" in state:
+                if book["save_info"]:
+                    with open(os.path.join(state["final_path"], "info.json"), "w") as w:
+                        w.write(json.dumps(state["audiobook_info"], indent=4))
+                state["manifest"].set_complete()
+            elif book["save_info"]:
+                with open(os.path.join(state["final_path"], "loan.json"), "w") as w:
+                    w.write(json.dumps(state["loan"], indent=4))
+            if self.libby.title_index is not None:
+                self.libby.title_index.add([state["media_info"]], state["final_path"])
+            self.set_result(key, path_=state["final_path"])
+        except Exception as e:
+            self.set_result(key, error=str(e))
+
+    def set_result(self, key: str, error: str = None, path_: str = None):
+        with self.changed:
+            book = self.data["books"][key]
+            state = self.active.get(key, {})
+            result = {"id": book["id"], "format": book["format"], "status": "error" if error else "ok",
+                      "seconds": round(time.monotonic() - state["start"], 3) if "start" in state else 0}
+            if error:
+                book.update(status="error", error=error)
+                result["error"] = error
+            else:
+                book["status"] = "done"
+                result["path"] = path_
+            self.results[key] = result
+            self._save()
+
+    def report(self, filename: str, mb: int):
+        with self.progress_lock:
+            if self.callback:
+                self.callback(filename, mb)
+            else:
+                print(f"{filename}: Downloaded {mb}MB.")
+
+    def _save(self):
+        # Called with the lock held
+        if self.path:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as w:
+                w.write(json.dumps(self.data, indent=4, sort_keys=True))
+            os.replace(tmp_path, self.path)
+
+
+def load_jobs(path_: str) -> list[dict]:
+    # A job file is either a JSON list like [{"op": "borrow", "id": "123"}, {"op": "download", "id": "123", "format": "audiobook-mp3"}]
+    # or a CSV file with the columns op,id,format (and optionally days).
+    with open(path_, "r", newline="") as r:
+        if path_.lower().endswith(".csv"):
+            jobs = [{k.strip(): (v or "").strip() for k, v in row.items() if k} for row in csv.DictReader(r)]
+        else:
+            jobs = json.loads(r.read())
+    for job in jobs:
+        if job.get("op") not in ("borrow", "download", "return") or not job.get("id"):
+            raise RuntimeError(f"Invalid job: {job}")
+        job["id"] = str(job["id"])
+        job["format"] = job.get("format") or None
+    return jobs
+
+
+def positive_int(value: str) -> int:
+    # For --host-limit, where 0 would make every request to the host wait forever
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid whole number: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got '{value}'")
+    return number
+
+
+def positive_float(value: str) -> float:
+    # For --bandwidth and --rate-limit, where 0 or less makes no sense
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number: '{value}'")
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"must be more than 0, got '{value}'")
+    return number
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -371,19 +1915,100 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--search", help="Search for book in your libraries.", metavar='"search query"')
     parser.add_argument("-sa", "--search-audiobook", help="Search for audiobook in your libraries.", metavar='"search query"')
     parser.add_argument("-se", "--search-ebook", help="Search for ebook in your libraries.", metavar='"search query"')
+    parser.add_argument("-sl", "--search-local", help="Search the titles you have seen before (searched, looked up or downloaded), without going online. Words can be limited to one of title, authors, narrators, series, isbn, languages and publisher, like 'authors:tolkien'.", metavar='"search query"')
+    parser.add_argument("--reindex", help="Add the books downloaded with '--save-info' in this folder to the local index.", metavar="path")
+    parser.add_argument("--index-file", help="Where to keep the local index. Defaults to 'index.sqlite' next to the id file.", metavar="path")
     parser.add_argument("-ls", "--list-loans", help="List your current loans.", action="store_true")
     parser.add_argument("-lsc", "--list-cards", help="List your current cards.", action="store_true")
     parser.add_argument("-b", "--borrow-book", help="Borrow book from the first library where it's available.", metavar="id")
+    parser.add_argument("-p", "--priority", help="Which library to borrow from when the book is available at several. 'order' takes the first card, 'copies' the library with most copies available.", choices=["order", "copies"], default="order")
     parser.add_argument("-r", "--return-book", help="Return book. If the same book is borrowed in multiple libraries this will only return the first one.", metavar="id")
     parser.add_argument("-dl", "--download", help="Download book or audiobook by title id. You need to have borrowed the book.", metavar="id")
-    parser.add_argument("-f", "--format", help="Which format to download.", type=str, metavar="id", required="-dl" in sys.argv or "--download" in sys.argv)
+    parser.add_argument("-f", "--format", help="Which format to download.", type=str, metavar="id", required=any(a in sys.argv for a in ["-dl", "--download", "--enqueue"]))
     parser.add_argument("-odm", help="Download the ODM instead of directly downloading mp3's for 'audiobook-mp3'.", action="store_true")
+    parser.add_argument("-w", "--workers", help="How many audiobook parts to download at the same time.", type=int, default=4, metavar="n")
+    parser.add_argument("--enqueue", help="Add a loan (in the format given with -f) to the download queue.", metavar="id")
+    parser.add_argument("--enqueue-loans", help="Add all your loans to the download queue, audiobooks as audiobook-mp3 and ebooks as ebook-epub-adobe.", action="store_true")
+    parser.add_argument("--queue-priority", help="Priority of what is added to the download queue, higher goes first. Otherwise loans that expire first go first.", type=int, default=0, metavar="n")
+    parser.add_argument("--run-queue", help="Download everything in the download queue. Uses --workers, --host-limit and --bandwidth.", action="store_true")
+    parser.add_argument("--queue-file", help="Where to keep the download queue. Defaults to 'download_queue.json' next to the id file.", metavar="path")
+    parser.add_argument("--bandwidth", help="Max download speed, in bytes per second.", type=positive_float, metavar="bytes")
+    parser.add_argument("--asset-store", help="Keep covers once in this folder and link them into the book folders.", metavar="path")
+    parser.add_argument("--hash", help="Store a SHA-256 of every downloaded audiobook part in the manifest.", action="store_true")
+    parser.add_argument("--tag", help="Add an ID3v1 tag (part, title, author and year) to downloaded audiobook parts.", action="store_true")
     parser.add_argument("-si", "--save-info", help="Save information about downloaded book.", action="store_true")
     parser.add_argument("-i", "--info", help="Print media info (JSON).", type=str, metavar="id")
+    parser.add_argument("--cache-file", help="Where to cache media info. Defaults to 'cache.sqlite' next to the id file.", metavar="path")
+    parser.add_argument("--cache-ttl", help="How many seconds cached media info is valid. Defaults to a week.", type=float, default=7 * 24 * 60 * 60, metavar="seconds")
+    parser.add_argument("--no-cache", help="Don't use cached media info.", action="store_true")
+    parser.add_argument("--batch", help="Run borrow/download/return jobs from a JSON or CSV file.", metavar="path")
+    parser.add_argument("--batch-workers", help="How many titles to work on at the same time in batch mode.", type=int, default=4, metavar="n")
+    parser.add_argument("--report", help="Write the batch results (JSON) to this file instead of printing them.", metavar="path")
+    parser.add_argument("--host-limit", help="Max concurrent requests to a host, can be given several times.", action="append", default=[], metavar="host=n")
+    parser.add_argument("--pages", help="Max number of result pages to get when searching, 0 gets all of them. Defaults to 1.", type=int, default=1, metavar="n")
+    parser.add_argument("--jsonl", help="Output search results as JSON lines, one hit per line as soon as it arrives.", action="store_true")
+    parser.add_argument("--rate-limit", help="Max requests per second to a host (optionally with how many can be sent in a burst), can be given several times.", action="append", default=[], metavar="host=rate[/burst]")
+    parser.add_argument("--retries", help="How many times to retry failed requests.", type=int, default=5, metavar="n")
+    parser.add_argument("--stats", help="Print how many requests were made and how long they took when done.", action="store_true")
+    parser.add_argument("--watch", help="Keep polling your loans and holds and print what changes (JSON lines).", action="store_true")
+    parser.add_argument("--mirror", help="Where to keep the last seen loans and holds for --watch. Defaults to 'sync_mirror.json' next to the id file.", metavar="path")
+    parser.add_argument("--watch-interval", help="Shortest and longest time between polls in --watch.", type=float, nargs=2, default=[60, 900], metavar=("min", "max"))
     parser.add_argument("-j", "--json", help="Output verbose JSON instead of tables.", action="store_true")
     args = parser.parse_args()
 
-    L = Libby(args.id_file, code=args.code)
+    def format_table(rows: list) -> str:
+        # tabulate is only imported when there is a table to show
+        from tabulate import tabulate
+        return tabulate(rows, headers="keys", tablefmt="grid")
+
+    if args.pages < 0:
+        parser.error(f"argument --pages: must be 0 or more, got '{args.pages}'")
+    host_limits = {}
+    for limit in args.host_limit:
+        host, _, n = limit.partition("=")
+        try:
+            host_limits[host] = positive_int(n)
+        except argparse.ArgumentTypeError as e:
+            parser.error(f"argument --host-limit: {e}")
+    rate_limits = {}
+    for limit in args.rate_limit:
+        host, _, rate = limit.partition("=")
+        rate, _, burst = rate.partition("/")
+        try:
+            rate_limits[host] = (positive_float(rate), positive_float(burst) if burst else None)
+        except argparse.ArgumentTypeError as e:
+            parser.error(f"argument --rate-limit: {e}")
+    if args.no_cache:
+        # Still keep the cache in memory, a single run asks for the same media info many times
+        cache = MediaInfoCache(ttl=args.cache_ttl)
+    else:
+        cache = MediaInfoCache(args.cache_file or os.path.join(os.path.dirname(os.path.abspath(args.id_file)), "cache.sqlite"),
+                               ttl=args.cache_ttl)
+    title_index = TitleIndex(args.index_file or os.path.join(os.path.dirname(os.path.abspath(args.id_file)), "index.sqlite"))
+    stats = Stats()
+    if args.stats:
+        # Printed to stderr so it doesn't end up in JSON output, and at exit so we also get it when something fails
+        atexit.register(lambda: print(format_table(stats.get_table()) + "\n" +
+                                      format_table(stats.get_cache_table()), file=sys.stderr))
+    # Only log in when a command needs it. With an id file the login check is remembered in 'validation.json'
+    # next to it for a while, so a command run from cron doesn't need an extra sync just to find out.
+    L = None
+    if any([args.code, args.search, args.search_audiobook, args.search_ebook, args.list_loans, args.list_cards,
+            args.borrow_book, args.return_book, args.download, args.info, args.batch, args.watch, args.enqueue,
+            args.enqueue_loans, args.run_queue]):
+        libby_args = dict(pool_size=max(10, args.workers * args.batch_workers), cache=cache, host_limits=host_limits,
+                          rate_limits=rate_limits, retries=args.retries, stats=stats, title_index=title_index,
+                          assets=AssetStore(args.asset_store) if args.asset_store else None, bandwidth=args.bandwidth)
+        if args.code or not os.path.isfile(args.id_file):
+            L = Libby(args.id_file, code=args.code, **libby_args)
+        else:
+            validation_path = os.path.join(os.path.dirname(os.path.abspath(args.id_file)), "validation.json")
+            L = AccountManager([args.id_file], validation_path=validation_path, **libby_args).get(args.id_file)
+    queue = None
+    if args.enqueue or args.enqueue_loans or args.run_queue:
+        queue = DownloadQueue(L, args.queue_file or os.path.join(os.path.dirname(os.path.abspath(args.id_file)), "download_queue.json"),
+                              workers=args.workers, host_limits=host_limits)
+        queue_args = dict(priority=args.queue_priority, get_odm=args.odm, save_info=args.save_info, hash_parts=args.hash, tag_parts=args.tag)
     def create_table(media_infos: list, narrators=True):
         table = []
         for m in media_infos:
@@ -416,8 +2041,9 @@ if __name__ == "__main__":
                 s = L.get_sync()
                 t = []
                 print("Loans:")
+                media_infos = L.get_media_infos([lo["id"] for lo in loans])
                 for lo in loans:
-                    mi = L.get_media_info(lo["id"])
+                    mi = media_infos[lo["id"]]
                     t.append({
                         "Id": lo['id'],
                         "Type": lo['type']['id'],
@@ -428,7 +2054,7 @@ if __name__ == "__main__":
                         "Title": lo['title'],
                         "Narrators": "\n".join(L.get_narrator_by_media_info(mi).split(" and "))
                     })
-                print(tabulate(t, headers="keys", tablefmt="grid"))
+                print(format_table(t))
 
         elif arg in ["-lsc", "--list-cards"]:
             s = L.get_sync()
@@ -442,46 +2068,107 @@ if __name__ == "__main__":
                         "Id": c['cardId'],
                         "Library": c["advantageKey"]
                     })
-                print(tabulate(t, headers="keys", tablefmt="grid"))
+                print(format_table(t))
 
         elif arg in ["-dl", "--download"]:
             print("Downloading", sys.argv[arg_pos + 1])
-            L.download_loan(L.get_loan(sys.argv[arg_pos + 1]), args.format, args.output, args.save_info, get_odm=args.odm)
+            L.download_loan(L.get_loan(sys.argv[arg_pos + 1]), args.format, args.output, args.save_info, get_odm=args.odm, workers=args.workers,
+                            hash_parts=args.hash, tag_parts=args.tag)
 
         elif arg in ["-r", "--return-book"]:
             L.return_book(sys.argv[arg_pos + 1])
             print(f"Book returned: {sys.argv[arg_pos + 1]}")
 
         elif arg in ["-b", "--borrow-book"]:
-            L.borrow_book_on_any_logged_in_library(sys.argv[arg_pos + 1])
+            L.borrow_book_on_any_logged_in_library(sys.argv[arg_pos + 1], priority=args.priority)
             print(f"Book borrowed: {sys.argv[arg_pos + 1]}")
 
+        elif arg == "--batch":
+            results = L.run_jobs(load_jobs(sys.argv[arg_pos + 1]), args.output, workers=args.batch_workers,
+                                 part_workers=args.workers, save_info=args.save_info, get_odm=args.odm,
+                                 priority=args.priority, hash_parts=args.hash, tag_parts=args.tag)
+            if args.report:
+                with open(args.report, "w") as w:
+                    w.write(json.dumps(results, indent=4))
+                job_results = [r for r in results if r["op"] != "prefetch"]
+                print(f"Batch done, {sum(r['status'] == 'ok' for r in job_results)} of {len(job_results)} jobs ok. Report written to {args.report}.")
+            else:
+                print(json.dumps(results, indent=4))
+
+        elif arg == "--enqueue":
+            loan = L.get_loan(sys.argv[arg_pos + 1])
+            if not loan:
+                raise RuntimeError("Can't queue a book that is not checked out.")
+            queue.add(loan, args.format, args.output, **queue_args)
+            print(f"Queued: {sys.argv[arg_pos + 1]}")
+
+        elif arg == "--enqueue-loans":
+            print(f"Queued {len(queue.add_loans(L.get_loans(), args.output, **queue_args))} loans.")
+
+        elif arg == "--run-queue":
+            results = queue.run()
+            if args.report:
+                with open(args.report, "w") as w:
+                    w.write(json.dumps(results, indent=4))
+                print(f"Queue done, {sum(r['status'] == 'ok' for r in results)} of {len(results)} books ok. Report written to {args.report}.")
+            else:
+                print(json.dumps(results, indent=4))
+
+        elif arg == "--watch":
+            mirror = SyncMirror(args.mirror or os.path.join(os.path.dirname(os.path.abspath(args.id_file)), "sync_mirror.json"))
+            try:
+                for event in L.watch(mirror, *args.watch_interval):
+                    print(json.dumps(event), flush=True)
+            except KeyboardInterrupt:
+                pass
+
         elif arg in ["-i", "--info"]:
             mi = L.get_media_info(sys.argv[arg_pos + 1])
             print(json.dumps(mi, indent=4))
 
-        elif arg in ["-s", "--search"]:
-            hits = L.search_for_book_in_logged_in_libraries(sys.argv[arg_pos + 1])
-            if args.json:
-                print(json.dumps(hits, indent=4))
-            else:
-                print("Search:")
-                print(tabulate(create_table(hits), headers="keys", tablefmt="grid"))
-
-        elif arg in ["-sa", "--search-audiobook"]:
-            hits = L.search_for_audiobook_in_logged_in_libraries(sys.argv[arg_pos + 1])
-            if args.json:
-                print(json.dumps(hits, indent=4))
+        elif arg in ["-s", "--search", "-sa", "--search-audiobook", "-se", "--search-ebook"]:
+            media_type, title = {
+                "-s": (None, "Search:"), "--search": (None, "Search:"),
+                "-sa": ("audiobook", "Search Audiobook:"), "--search-audiobook": ("audiobook", "Search Audiobook:"),
+                "-se": ("ebook", "Search Ebook:"), "--search-ebook": ("ebook", "Search Ebook:"),
+            }[arg]
+            pages = L.iter_search_pages(sys.argv[arg_pos + 1], media_type, max_pages=args.pages or None)
+            if args.jsonl:
+                for hits in pages:
+                    for h in hits:
+                        print(json.dumps(h), flush=True)
+            elif args.json:
+                # The same as dumping one list, but written a page at a time so all pages are never kept at once
+                separator = "[\n"
+                for hits in pages:
+                    for h in hits:
+                        sys.stdout.write(separator + textwrap.indent(json.dumps(h, indent=4), "    "))
+                        separator = ",\n"
+                    sys.stdout.flush()
+                print("[]" if separator == "[\n" else "\n]")
             else:
-                print("Search Audiobook:")
-                print(tabulate(create_table(hits), headers="keys", tablefmt="grid"))
+                print(title)
+                # One table per page, so the first results show up without waiting for the rest
+                for hits in pages:
+                    print(format_table(create_table(hits, narrators=media_type != "ebook")), flush=True)
 
-        elif arg in ["-se", "--search-ebook"]:
-            hits = L.search_for_ebook_in_logged_in_libraries(sys.argv[arg_pos + 1])
+        elif arg in ["-sl", "--search-local"]:
+            hits = title_index.search(sys.argv[arg_pos + 1])
             if args.json:
                 print(json.dumps(hits, indent=4))
             else:
-                print("Search Ebook:")
-                print(tabulate(create_table(hits, narrators=False), headers="keys", tablefmt="grid"))
+                print("Search Local:")
+                print(format_table([{
+                    "Id": h["id"],
+                    "Type": h["type"],
+                    "Authors": "\n".join(h["authors"].split(" and ")),
+                    "Title": h["title"],
+                    "Narrators": "\n".join(h["narrators"].split(" and ")),
+                    "Series": h["series"],
+                    "Path": h["path"] or "",
+                } for h in hits]))
+
+        elif arg == "--reindex":
+            print(f"Indexed {title_index.reindex(sys.argv[arg_pos + 1])} books.")
 
         arg_pos += 1
\ No newline at end of file
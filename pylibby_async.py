@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2022 Raymond Olsen
+#
+# This file is part of PyLibby.
+#
+# PyLibby is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyLibby is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyLibby. If not, see <http://www.gnu.org/licenses/>.
+
+# asyncio version of Libby, for running many accounts from one event loop.
+#
+#     async with aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar()) as session:
+#         limit = asyncio.Semaphore(50)
+#         clients = [AsyncLibby(p, session=session, semaphore=limit) for p in id_files]
+#         for c in clients:
+#             await c.login()
+#         loans = await asyncio.gather(*(c.get_loans() for c in clients))
+#
+# Every request carries its own Authorization header and cookies, so one session (and its connection pool)
+# can be shared by any number of identities. Give a shared session a DummyCookieJar, otherwise the cookies
+# open_audiobook gets for one identity would also be sent for the others.
+#
+# Downloads decide what to do with each answer the same way Libby does (see the part helpers in LibbyBase).
+# Writing files and the manifest happens in asyncio.to_thread, so a slow disk doesn't hold up the event loop.
+
+import asyncio
+import json
+import os
+import time
+import urllib.parse
+from typing import AsyncIterator, Callable
+
+import aiohttp
+
+from pylibby import LibbyBase, MediaInfoCache, DownloadManifest, PartWriter, Stats, TitleIndex
+
+
+class AsyncLibby(LibbyBase):
+    def __init__(self, id_path: str, session: aiohttp.ClientSession = None, semaphore: asyncio.Semaphore = None,
+                 cache: MediaInfoCache = None, sync_max_age: float = 30, sentry_url: str = None, thunder_url: str = None,
+                 title_index: TitleIndex = None, stats: Stats = None, bandwidth: float = None):
+        self.id_path = id_path
+        self.title_index = title_index
+        self.stats = stats if stats is not None else Stats()
+        self.bandwidth_limit = self.get_bandwidth_limit(bandwidth)
+        if sentry_url:
+            self.sentry_url = sentry_url
+        if thunder_url:
+            self.thunder_url = thunder_url
+        self.session = session
+        self.own_session = session is None
+        # Bounds how many requests this client (or all clients sharing the semaphore) has in flight
+        self.semaphore = semaphore if semaphore is not None else asyncio.Semaphore(10)
+        self.media_info_cache = cache if cache is not None else MediaInfoCache()
+        self.sync_max_age = sync_max_age
+        self.sync_snapshot = None
+        self.sync_time = 0.0
+        self.sync_lock = asyncio.Lock()
+        self.headers = {
+            "Accept": "application/json",
+        }
+        # (domain, name, value), kept per client instead of in the session's cookie jar
+        self.cookies = []
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def login(self, code: str = None):
+        identity = await asyncio.to_thread(self.read_identity)
+        if identity is not None:
+            self.headers.update({'Authorization': f'Bearer {identity["identity"]}'})
+            if not await self.is_logged_in():
+                if not code:
+                    raise self.get_login_error()
+                await self.clone_by_code(code)
+                if not await self.is_logged_in():
+                    raise self.get_login_error(code)
+        elif code:
+            await self.get_chip()
+            await self.clone_by_code(code)
+            if not await self.is_logged_in():
+                raise self.get_login_error(code)
+            #Updating id file
+            await self.get_chip()
+        else:
+            raise self.get_login_error()
+
+    async def close(self):
+        if self.own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar())
+        return self.session
+
+    def get_cookies(self, url: str) -> dict:
+        host = urllib.parse.urlsplit(url).hostname or ""
+        return {name: value for domain, name, value in self.cookies if host == domain or host.endswith("." + domain)}
+
+    def remember_cookies(self, resp: aiohttp.ClientResponse):
+        for r in (*resp.history, resp):
+            for name, morsel in r.cookies.items():
+                domain = morsel["domain"].lstrip(".") or r.url.host
+                self.cookies = [c for c in self.cookies if c[:2] != (domain, name)] + [(domain, name, morsel.value)]
+
+    async def request(self, method: str, url: str, headers: dict = None, **kwargs) -> tuple[int, dict]:
+        endpoint = self.stats.get_endpoint(method, url)
+        start = time.monotonic()
+        async with self.semaphore:
+            try:
+                async with self.get_session().request(method, url, headers=self.headers if headers is None else headers,
+                                                      cookies=self.get_cookies(url), **kwargs) as resp:
+                    self.remember_cookies(resp)
+                    body = await resp.read()
+            except aiohttp.ClientError as e:
+                self.stats.record({"type": "request", "endpoint": endpoint, "seconds": time.monotonic() - start,
+                                   "error": type(e).__name__})
+                raise
+        self.stats.record({"type": "request", "endpoint": endpoint, "seconds": time.monotonic() - start,
+                           "status": resp.status, "bytes": len(body)})
+        return resp.status, json.loads(body) if body else None
+
+    async def get_json(self, url: str, **kwargs) -> dict:
+        return (await self.request("GET", url, **kwargs))[1]
+
+    async def is_logged_in(self) -> bool:
+        return self.is_logged_in_by_sync(await self.get_sync())
+
+    async def get_sync(self, max_age: float = None) -> dict:
+        if max_age is None:
+            max_age = self.sync_max_age
+        async with self.sync_lock:
+            if self.sync_snapshot is not None and time.monotonic() - self.sync_time < max_age:
+                return self.sync_snapshot
+            self.sync_snapshot = await self.get_json(self.sync_url())
+            self.sync_time = time.monotonic()
+            return self.sync_snapshot
+
+    def invalidate_sync(self):
+        self.sync_snapshot = None
+
+    async def get_chip(self) -> dict:
+        response = (await self.request("POST", self.chip_url(), params={"client": "dewey"}))[1]
+        self.headers.update({'Authorization': f'Bearer {response["identity"]}'})
+        self.invalidate_sync()
+        await asyncio.to_thread(self.write_identity, response)
+
+        return response
+
+    async def clone_by_code(self, code: int) -> dict:
+        status, resp = await self.request("POST", self.clone_url(), data={"code": str(code)})
+        self.invalidate_sync()
+        await self.get_chip()
+        return resp
+
+    async def get_media_info(self, title_id: str, use_cache: bool = True) -> dict:
+        if use_cache:
+            media_info = self.media_info_cache.get(title_id)
+            self.stats.record({"type": "cache", "name": "media_info", "hit": media_info is not None})
+            if media_info is not None:
+                return media_info
+        media_info = await self.get_json(self.media_url(title_id))
+        if "id" in media_info:
+            self.media_info_cache.put(title_id, media_info)
+            if self.title_index is not None:
+                self.title_index.add([media_info])
+        return media_info
+
+    async def get_media_infos(self, title_ids: list[str], use_cache: bool = True, bulk_size: int = 50) -> dict[str, dict]:
+        title_ids = list(dict.fromkeys(str(title_id) for title_id in title_ids))
+        media_infos = {}
+        missing = []
+        for title_id in title_ids:
+            media_info = self.media_info_cache.get(title_id) if use_cache else None
+            if use_cache:
+                self.stats.record({"type": "cache", "name": "media_info", "hit": media_info is not None})
+            if media_info is not None:
+                media_infos[title_id] = media_info
+            else:
+                missing.append(title_id)
+
+        async def get_bulk(chunk: list[str]) -> list:
+            status, bulk = await self.request("GET", self.media_bulk_url(chunk))
+            return bulk if status == 200 else []
+
+        chunks = [missing[i:i + bulk_size] for i in range(0, len(missing), bulk_size)]
+        for bulk in await asyncio.gather(*(get_bulk(chunk) for chunk in chunks)):
+            media_infos.update(self.store_media_infos(bulk))
+        missing = self.get_missing_media_infos(missing, media_infos)
+        for title_id, media_info in zip(missing, await asyncio.gather(*(self.get_media_info(t, use_cache=False) for t in missing))):
+            media_infos[title_id] = media_info
+
+        return {title_id: media_infos[title_id] for title_id in title_ids}
+
+    async def get_loans(self) -> list:
+        return (await self.get_sync())["loans"]
+
+    async def have_loan(self, title_id: str) -> bool:
+        return bool(await self.get_loan(title_id))
+
+    async def get_loan(self, title_id: str) -> dict:
+        return self.get_loan_by_sync(await self.get_sync(), title_id)
+
+    async def iter_search_pages(self, query: str, media_type: str = None, per_page: int = 24, max_pages: int = None) -> AsyncIterator[list]:
+        libraries = [card["advantageKey"] for card in (await self.get_sync())["cards"]]
+        page = 1
+        while max_pages is None or page <= max_pages:
+            response = await self.get_json(self.search_url(libraries, query, media_type, page, per_page))
+            hits, more = self.get_search_hits(response, media_type, per_page)
+            if hits:
+                yield hits
+            if not more:
+                break
+            page += 1
+
+    async def iter_search(self, query: str, media_type: str = None, per_page: int = 24, max_pages: int = None) -> AsyncIterator[dict]:
+        async for hits in self.iter_search_pages(query, media_type, per_page, max_pages):
+            for h in hits:
+                yield h
+
+    async def search_for_book_in_logged_in_libraries(self, query: str, max_pages: int = 1) -> list:
+        return [h async for h in self.iter_search(query, max_pages=max_pages)]
+
+    async def search_for_audiobook_in_logged_in_libraries(self, query: str, max_pages: int = 1) -> list:
+        return [h async for h in self.iter_search(query, "audiobook", max_pages=max_pages)]
+
+    async def search_for_ebook_in_logged_in_libraries(self, query: str, max_pages: int = 1) -> list:
+        return [h async for h in self.iter_search(query, "ebook", max_pages=max_pages)]
+
+    async def get_availability(self, library: str, title_id: str) -> dict:
+        return await self.get_json(self.availability_url(library, title_id))
+
+    async def is_book_available(self, library: str, title_id: str) -> bool:
+        return bool((await self.get_availability(library, title_id)).get("isAvailable", False))
+
+    async def borrow_book(self, title_id: str, card_id: str, days: int = 21) -> dict:
+        j = self.get_borrow_request(await self.get_media_info(title_id), days)
+        status, resp = await self.request("POST", self.loan_url(card_id, title_id), json=j)
+        self.invalidate_sync()
+        if status != 200:
+            raise RuntimeError(f"Couldn't borrow book: {resp}, you may need to verify your card in the app.")
+        return resp
+
+    async def borrow_book_on_any_logged_in_library(self, title_id: str, days: int = 21, priority: str = "order") -> dict:
+        if priority not in ("order", "copies"):
+            raise ValueError(f"Unknown priority: {priority}")
+
+        cards = self.get_cards_with_room(await self.get_sync())
+        tasks = [asyncio.ensure_future(self.get_availability(card["advantageKey"], title_id)) for card in cards]
+        try:
+            if priority == "order":
+                for card, task in zip(cards, tasks):
+                    if (await task).get("isAvailable"):
+                        print(f"Book available at {card['advantageKey']}.")
+                        return await self.borrow_book(title_id, card["cardId"], days)
+                    print(f"Book not available at {card['advantageKey']}.")
+            else:
+                card = self.pick_card_by_copies(cards, await asyncio.gather(*tasks))
+                if card:
+                    return await self.borrow_book(title_id, card["cardId"], days)
+        finally:
+            for task in tasks:
+                task.cancel()
+        print("Book not available at any of your libraries.")
+        return {}
+
+    async def return_book(self, title_id: str, card_id: str = None):
+        if not card_id:
+            card_id = (await self.get_loan(title_id)).get("cardId")
+
+        if not card_id:
+            raise RuntimeError("Couldn't find cardId on loan or couldn't find loan at all, can't return it.")
+
+        status, resp = await self.request("DELETE", self.loan_url(card_id, title_id))
+        self.invalidate_sync()
+        if status != 200:
+            raise RuntimeError(f"Couldn't return book: {resp}, you may need to verify your card in the app.")
+
+    async def open_audiobook(self, card_id: str, title_id: str) -> dict:
+        loan = await self.get_loan(title_id)
+        if not loan:
+            raise RuntimeError("Can't open a book if it is not checked out.")
+
+        audiobook = await self.get_json(self.open_url(loan, card_id, title_id))
+
+        #We need this to set a cookie for us, and it has to be sent without our usual headers
+        web_url_with_message = self.get_web_url_with_message(audiobook)
+        async with self.semaphore:
+            async with self.get_session().get(web_url_with_message, cookies=self.get_cookies(web_url_with_message)) as resp:
+                self.remember_cookies(resp)
+
+        return {
+                "audiobook_urls": audiobook,
+                "openbook": await self.get_json(audiobook["urls"]["openbook"]),
+                "media_info": await self.get_media_info(title_id)
+                }
+
+    async def download_audiobook_mp3(self, loan: dict, output_path: str,
+                                     callback_functions: list[Callable[[str, int], None]] = None,
+                                     save_info=False, download_covers=True, workers: int = 4, hash_parts=False,
+                                     tag_parts=False):
+        if not os.path.exists(output_path):
+            raise RuntimeError(f"Path does not exist: {output_path}")
+
+        final_path = os.path.join(output_path, self.get_download_path(await self.get_media_info(loan["id"])))
+        os.makedirs(final_path, exist_ok=True)
+        manifest = await asyncio.to_thread(DownloadManifest, final_path)
+
+        if await asyncio.to_thread(self.is_downloaded, manifest, final_path, save_info):
+            print(f"Already downloaded to {final_path}.")
+            return
+
+        audiobook_info = await self.open_audiobook(loan["cardId"], loan["id"])
+
+        def report(filename: str, mb: int):
+            if callback_functions:
+                for f in callback_functions:
+                    f(filename, mb)
+            else:
+                print(f"{filename}: Downloaded {mb}MB.")
+
+        await asyncio.to_thread(manifest.set_complete, False)
+        parts = asyncio.Semaphore(max(1, workers))
+
+        async def download(url: str, size: int, stages: list):
+            async with parts:
+                return await self.download_part(url, final_path, report, manifest, size, stages)
+
+        await asyncio.gather(*(download(url, size, self.get_part_stages(audiobook_info["media_info"], track,
+                                                                        hash_parts, tag_parts))
+                               for track, (url, size) in enumerate(self.get_spine_parts(audiobook_info), 1)))
+
+        if save_info:
+            await asyncio.to_thread(self.write_json, os.path.join(final_path, "info.json"), audiobook_info)
+        if self.title_index is not None:
+            self.title_index.add([audiobook_info["media_info"]], final_path)
+
+        if download_covers:
+            await self.download_covers(loan, final_path, manifest)
+
+        await asyncio.to_thread(manifest.set_complete)
+
+    def write_json(self, path_: str, data):
+        with open(path_, "w") as w:
+            w.write(json.dumps(data, indent=4))
+
+    async def download_part(self, download_url: str, final_path: str, callback: Callable[[str, int], None],
+                            manifest: DownloadManifest = None, expected_size: int = None, stages: list = None) -> str:
+        filename = self.get_filename(download_url)
+        file_path = os.path.join(final_path, filename)
+        stages = stages or []
+        if manifest is None:
+            manifest = await asyncio.to_thread(DownloadManifest, final_path)
+        if manifest.is_done(filename, final_path):
+            return file_path
+
+        tmp_path = file_path + ".part"
+        while True:
+            offset, headers = self.get_resume_request(manifest, filename, download_url, tmp_path)
+            async with self.semaphore:
+                async with self.get_session().get(download_url, headers=headers, cookies=self.get_cookies(download_url),
+                                                  timeout=aiohttp.ClientTimeout(sock_read=10)) as resp:
+                    size = manifest.get(filename).get("size")
+                    action = self.get_part_action(resp.status, size, offset, filename, resp.headers)
+                    if action == "stale":
+                        # Start over, without a Range header this can't happen again
+                        await asyncio.to_thread(self.reset_part, manifest, filename, tmp_path)
+                        continue
+                    if action == "done":
+                        for stage in stages:
+                            await asyncio.to_thread(stage.start, tmp_path, offset)
+                        completed = offset
+                    else:
+                        if action == "restart":
+                            size = await asyncio.to_thread(self.restart_part, manifest, filename, download_url,
+                                                           resp.headers, expected_size)
+                            offset = 0
+                        completed = await self.write_part(resp, tmp_path, offset, filename, manifest, callback,
+                                                          size, stages)
+
+            return await asyncio.to_thread(self.finish_part, tmp_path, file_path, filename, manifest, completed,
+                                           size, stages)
+
+    async def write_part(self, resp: aiohttp.ClientResponse, tmp_path: str, offset: int, filename: str,
+                         manifest: DownloadManifest, callback: Callable[[str, int], None], size: int = None,
+                         stages: list = ()) -> int:
+        # The writer runs in another thread, progress is reported back on the event loop
+        loop = asyncio.get_running_loop()
+        writer = await asyncio.to_thread(PartWriter, tmp_path, offset, filename, manifest,
+                                         lambda f, mb: loop.call_soon_threadsafe(callback, f, mb), size, stages)
+        try:
+            async for chunk in resp.content.iter_chunked(self.max_chunk_size):
+                await asyncio.to_thread(writer.write, chunk)
+                if self.bandwidth_limit is not None:
+                    wait = self.bandwidth_limit.get_wait(len(chunk))
+                    while wait:
+                        await asyncio.sleep(wait)
+                        wait = self.bandwidth_limit.get_wait(len(chunk))
+        finally:
+            await asyncio.to_thread(writer.close)
+            self.stats.record({"type": "bytes", "endpoint": self.stats.get_endpoint("GET", str(resp.url)),
+                               "bytes": writer.completed - offset})
+        return writer.completed
+
+    async def download_covers(self, media_info: dict, path_: str, manifest: DownloadManifest = None):
+        if "covers" in media_info:
+            if manifest is None:
+                manifest = await asyncio.to_thread(DownloadManifest, path_)
+            for c in media_info["covers"].keys():
+                filename = c + ".jpg"
+                href = media_info["covers"][c]["href"]
+                if manifest.is_done(filename, path_) and manifest.get(filename).get("url") == href:
+                    continue
+                file_path = os.path.join(path_, filename)
+                status, headers = await self.download_file(href, file_path)
+                if status != 200:
+                    print(f"Couldn't download cover {filename}: HTTP {status}.")
+                    continue
+                size = await asyncio.to_thread(os.path.getsize, file_path)
+                await asyncio.to_thread(manifest.update, filename, url=href, size=size, completed=size, done=True,
+                                        etag=headers.get("ETag"), last_modified=headers.get("Last-Modified"))
+
+    async def download_file(self, url: str, file_path: str, headers: dict = None) -> tuple[int, dict]:
+        # Streams a whole file to disk (through a .part file) like Libby.download_file, returns the status and
+        # headers. Nothing is written unless the status is 200.
+        async with self.semaphore:
+            async with self.get_session().get(url, headers=headers) as resp:
+                if resp.status == 200:
+                    tmp_path = file_path + ".part"
+                    w = await asyncio.to_thread(open, tmp_path, "wb")
+                    n = 0
+                    try:
+                        async for chunk in resp.content.iter_chunked(self.max_chunk_size):
+                            await asyncio.to_thread(w.write, chunk)
+                            n += len(chunk)
+                    finally:
+                        await asyncio.to_thread(w.close)
+                    await asyncio.to_thread(os.replace, tmp_path, file_path)
+                    self.stats.record({"type": "bytes", "endpoint": self.stats.get_endpoint("GET", url), "bytes": n})
+                return resp.status, resp.headers
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2022 Raymond Olsen
+#
+# This file is part of PyLibby.
+#
+# PyLibby is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyLibby is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyLibby. If not, see <http://www.gnu.org/licenses/>.
+
+# What pylibby and pylibby_transport both need. Only the standard library is imported here, so importing it
+# from either one doesn't load the other.
+
+import bisect
+import re
+import threading
+import time
+import urllib.parse
+from typing import Callable
+
+
+class Stats:
+    # Counts what Libby spends its time on: requests and latency per endpoint, bytes, retries and cache hits.
+    # Every event is also passed to the hooks (see add_hook) as a dict with at least a "type".
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.endpoints = {}
+        self.caches = {}
+
+    def add_hook(self, hook: Callable[[dict], None]):
+        self.hooks.append(hook)
+
+    def get_endpoint(self, method: str, url: str) -> str:
+        # Ids and file names are replaced so all calls to the same kind of endpoint end up together
+        parts = urllib.parse.urlsplit(url)
+        path_ = re.sub(r"/libraries/[^/]+", "/libraries/{library}", parts.path)
+        path_ = re.sub(r"/\d+(?=/|$)", "/{id}", path_)
+        path_ = re.sub(r"/[^/]+\.\w+$", "/{file}", path_)
+        return f"{method} {parts.hostname}{path_}"
+
+    def get_endpoint_stats(self, endpoint: str) -> dict:
+        return self.endpoints.setdefault(endpoint, {"calls": 0, "errors": 0, "retries": 0, "bytes": 0, "seconds": 0.0,
+                                                    "max_seconds": 0.0, "histogram": [0] * (len(self.latency_buckets) + 1)})
+
+    def record(self, event: dict):
+        with self.lock:
+            if event["type"] == "request":
+                e = self.get_endpoint_stats(event["endpoint"])
+                e["calls"] += 1
+                e["errors"] += 1 if event.get("error") or (event.get("status") or 0) >= 400 else 0
+                e["bytes"] += event.get("bytes") or 0
+                e["seconds"] += event["seconds"]
+                e["max_seconds"] = max(e["max_seconds"], event["seconds"])
+                e["histogram"][bisect.bisect_left(self.latency_buckets, event["seconds"])] += 1
+            elif event["type"] == "retry":
+                self.get_endpoint_stats(event["endpoint"])["retries"] += 1
+            elif event["type"] == "bytes":
+                self.get_endpoint_stats(event["endpoint"])["bytes"] += event["bytes"]
+            elif event["type"] == "cache":
+                c = self.caches.setdefault(event["name"], {"hits": 0, "misses": 0})
+                c["hits" if event["hit"] else "misses"] += 1
+        for hook in self.hooks:
+            hook(event)
+
+    def get_percentile(self, histogram: list[int], percentile: float) -> str:
+        # Histograms only give us the bucket, so this is "at most" that many seconds
+        total = sum(histogram)
+        seen = 0
+        for i, n in enumerate(histogram):
+            seen += n
+            if total and seen >= total * percentile:
+                return f"<{self.latency_buckets[i]}s" if i < len(self.latency_buckets) else f">{self.latency_buckets[-1]}s"
+        return ""
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "endpoints": {k: {**v, "histogram": list(v["histogram"])} for k, v in self.endpoints.items()},
+                "caches": {k: dict(v) for k, v in self.caches.items()},
+            }
+
+    def get_table(self) -> list[dict]:
+        table = []
+        with self.lock:
+            for endpoint, e in sorted(self.endpoints.items(), key=lambda i: -i[1]["seconds"]):
+                table.append({
+                    "Endpoint": endpoint,
+                    "Calls": e["calls"],
+                    "Errors": e["errors"],
+                    "Retries": e["retries"],
+                    "Total s": round(e["seconds"], 3),
+                    "Mean s": round(e["seconds"] / e["calls"], 3) if e["calls"] else "",
+                    "p50": self.get_percentile(e["histogram"], 0.5),
+                    "p95": self.get_percentile(e["histogram"], 0.95),
+                    "Max s": round(e["max_seconds"], 3),
+                    "MB": round(e["bytes"] / 1000000, 2),
+                })
+        return table
+
+    def get_cache_table(self) -> list[dict]:
+        with self.lock:
+            return [{"Cache": name, "Hits": c["hits"], "Misses": c["misses"]} for name, c in self.caches.items()]
+
+
+class TokenBucket:
+    # Lets through rate requests per second on average, and up to burst at once
+    def __init__(self, rate: float, burst: float = None):
+        # A rate of 0 would never let anything through (and divide by zero while waiting)
+        if not rate > 0:
+            raise ValueError(f"Rate must be more than 0, got {rate}.")
+        if burst is not None and not burst > 0:
+            raise ValueError(f"Burst must be more than 0, got {burst}.")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def get_wait(self, tokens: float = 1) -> float:
+        # Takes the tokens and returns 0 if they are there, otherwise how long to wait before asking again.
+        # Asking for more than burst (like a big chunk of bytes) goes through once the bucket is full,
+        # and is paid back before anyone else gets through
+        needed = min(tokens, self.burst)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= needed:
+                self.tokens -= tokens
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+    def acquire(self, tokens: float = 1):
+        # AsyncLibby uses get_wait with asyncio.sleep instead
+        while True:
+            wait = self.get_wait(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2022 Raymond Olsen
+#
+# This file is part of PyLibby.
+#
+# PyLibby is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyLibby is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyLibby. If not, see <http://www.gnu.org/licenses/>.
+
+# The HTTP side of Libby, kept apart so that "requests" is only imported when something actually goes online.
+# Importing pylibby (or running a local only command like -sl) doesn't pay for it.
+
+import email.utils
+import random
+import threading
+import time
+import urllib.parse
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pylibby_common import Stats, TokenBucket
+
+
+class LibbyAdapter(HTTPAdapter):
+    # Everything Libby sends goes through here. On top of the connection pool this
+    # - limits how many requests can be in flight to each host at the same time (host_limits, host -> n),
+    # - limits how many requests per second we send to each host (rate_limits, host -> (rate, burst)),
+    # - sets a timeout for requests that don't have one (timeouts, host -> (connect, read)),
+    # - retries connection errors, timeouts, 429 and 5xx with exponential backoff and jitter, respecting Retry-After.
+    # For streamed responses the host limit covers getting the headers, the body is read after we let go.
+    retry_statuses = (429, 500, 502, 503, 504)
+    # Things that go wrong now and then, a server that is slow under load or a connection that breaks off
+    retry_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+    # Safe to send again even if the server might have seen the first one
+    idempotent_methods = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+    default_timeouts = {
+        "sentry-read.svc.overdrive.com": (5, 30),
+        "thunder.api.overdrive.com": (5, 15),
+    }
+    default_rate_limits = {
+        "sentry-read.svc.overdrive.com": (5, 10),
+        "thunder.api.overdrive.com": (10, 20),
+    }
+
+    def __init__(self, host_limits: dict[str, int] = None, rate_limits: dict[str, tuple[float, float]] = None,
+                 timeouts: dict[str, tuple[float, float]] = None, retries: int = 5, backoff: float = 0.5,
+                 max_backoff: float = 60, default_timeout: tuple[float, float] = (5, 60), stats: Stats = None, **kwargs):
+        self.stats = stats if stats is not None else Stats()
+        self.host_limits = dict(host_limits or {})
+        for host, n in self.host_limits.items():
+            # With 0 every request to the host would wait forever
+            if not n >= 1:
+                raise ValueError(f"Host limit for {host} must be at least 1, got {n}.")
+        self.host_semaphores = {host: threading.BoundedSemaphore(n) for host, n in self.host_limits.items()}
+        self.rate_limits = {**self.default_rate_limits, **(rate_limits or {})}
+        self.buckets = {host: TokenBucket(*limit) for host, limit in self.rate_limits.items() if limit}
+        self.timeouts = {**self.default_timeouts, **(timeouts or {})}
+        self.default_timeout = default_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        super().__init__(**kwargs)
+
+    def get_backoff(self, attempt: int) -> float:
+        # Exponential backoff with "equal jitter", so clients that failed together don't retry together
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def get_retry_after(self, response) -> Optional[float]:
+        retry_after = response.headers.get("Retry-After")
+        if not retry_after:
+            return None
+        try:
+            return min(self.max_backoff, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(retry_after)
+            return min(self.max_backoff, max(0.0, when.timestamp() - time.time()))
+        except (TypeError, ValueError):
+            return None
+
+    def send(self, request, **kwargs):
+        host = urllib.parse.urlsplit(request.url).hostname
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeouts.get(host, self.default_timeout)
+        semaphore = self.host_semaphores.get(host)
+        bucket = self.buckets.get(host)
+        endpoint = self.stats.get_endpoint(request.method, request.url)
+        attempt = 0
+        while True:
+            if bucket:
+                bucket.acquire()
+            start = time.monotonic()
+            try:
+                if semaphore is None:
+                    response = super().send(request, **kwargs)
+                else:
+                    with semaphore:
+                        response = super().send(request, **kwargs)
+                if not kwargs.get("stream"):
+                    # The session would read it right after anyway, doing it here lets us time and count it.
+                    # Streamed bodies are counted by whoever reads them.
+                    response.content
+            except requests.exceptions.RequestException as e:
+                self.stats.record({"type": "request", "endpoint": endpoint, "seconds": time.monotonic() - start,
+                                   "error": type(e).__name__})
+                # If we never got connected the server can't have done anything, otherwise only retry what is safe
+                if not isinstance(e, self.retry_errors) or attempt >= self.retries or \
+                        not (request.method in self.idempotent_methods or isinstance(e, requests.exceptions.ConnectTimeout)):
+                    raise
+                delay = self.get_backoff(attempt)
+            else:
+                self.stats.record({"type": "request", "endpoint": endpoint, "seconds": time.monotonic() - start,
+                                   "status": response.status_code,
+                                   "bytes": 0 if kwargs.get("stream") else len(response.content)})
+                # 429 means the request wasn't handled, so that is safe to send again for any method
+                if attempt >= self.retries or response.status_code not in self.retry_statuses or \
+                        not (request.method in self.idempotent_methods or response.status_code == 429):
+                    return response
+                retry_after = self.get_retry_after(response)
+                delay = retry_after if retry_after is not None else self.get_backoff(attempt)
+                response.close()
+            attempt += 1
+            self.stats.record({"type": "retry", "endpoint": endpoint, "attempt": attempt, "delay": delay})
+            time.sleep(delay)
@@ -0,0 +1,33 @@
+# Tests run against benchmarks/stub_server.py, nothing here needs network or a library card.
+
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from pylibby import Libby, MediaInfoCache
+from stub_server import StubServer
+
+
+@pytest.fixture
+def stub():
+    server = StubServer(loans=4, parts=3, part_size=100000).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def id_path(tmp_path):
+    path_ = tmp_path / "id.json"
+    path_.write_text(json.dumps({"identity": "stub-identity"}))
+    return str(path_)
+
+
+@pytest.fixture
+def libby(stub, id_path):
+    return Libby(id_path, cache=MediaInfoCache(), sentry_url=stub.url, thunder_url=stub.url, retries=0)
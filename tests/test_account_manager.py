@@ -0,0 +1,46 @@
+import base64
+import json
+import time
+
+from pylibby import AccountManager, Stats
+
+
+def get_jwt(exp: float) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).decode().rstrip("=")
+    return f"e30.{payload}.signature"
+
+
+def test_from_folder_only_takes_id_files(tmp_path):
+    (tmp_path / "id.json").write_text(json.dumps({"identity": "a"}))
+    (tmp_path / "other.json").write_text(json.dumps({"identity": "b"}))
+    (tmp_path / "validation.json").write_text(json.dumps({}))
+    (tmp_path / "sync_mirror.json").write_text(json.dumps({"cards": {}}))
+    (tmp_path / "download_queue.json").write_text(json.dumps({"books": {}}))
+    (tmp_path / "list.json").write_text(json.dumps([]))
+    (tmp_path / "broken.json").write_text("{")
+    (tmp_path / "notes.txt").write_text("identity")
+    accounts = AccountManager.from_folder(str(tmp_path))
+    assert accounts.id_paths == [str(tmp_path / "id.json"), str(tmp_path / "other.json")]
+
+
+def test_validation_is_remembered_and_chip_only_renewed_when_stale(stub, tmp_path):
+    ids = tmp_path / "ids"
+    ids.mkdir()
+    (ids / "fresh.json").write_text(json.dumps({"identity": get_jwt(time.time() + 24 * 60 * 60)}))
+    (ids / "stale.json").write_text(json.dumps({"identity": get_jwt(time.time() + 10)}))
+    validation_path = str(tmp_path / "validation.json")
+
+    def run() -> dict:
+        stats = Stats()
+        accounts = AccountManager.from_folder(str(ids), validation_path=validation_path, stats=stats,
+                                              sentry_url=stub.url, thunder_url=stub.url)
+        for _, libby in accounts:
+            pass
+        return {endpoint: e["calls"] for endpoint, e in stats.summary()["endpoints"].items()}
+
+    calls = run()
+    assert calls["POST 127.0.0.1/chip"] == 1
+    assert calls["GET 127.0.0.1/chip/sync"] == 2
+    # Both are validated now, and the renewed identity doesn't expire
+    assert run() == {}
+    assert json.loads((ids / "stale.json").read_text())["identity"] == "stub-identity"
@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+import json
+import os
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from pylibby import DownloadManifest, MediaInfoCache
+from pylibby_async import AsyncLibby
+
+
+def run(stub, id_path, function, **kwargs):
+    async def main():
+        async with AsyncLibby(id_path, cache=MediaInfoCache(), sentry_url=stub.url, thunder_url=stub.url,
+                              **kwargs) as libby:
+            return await function(libby)
+    return asyncio.run(main())
+
+
+def test_download_with_stages_and_stats(stub, id_path, tmp_path):
+    progress = []
+
+    async def download(libby):
+        loan = await libby.get_loan("1000")
+        await libby.download_audiobook_mp3(loan, str(tmp_path), [lambda f, mb: progress.append(f)],
+                                           hash_parts=True, tag_parts=True)
+        return libby.stats.summary()
+
+    summary = run(stub, id_path, download, bandwidth=10 ** 9)
+    folder = next(tmp_path.rglob(DownloadManifest.filename)).parent
+    manifest = DownloadManifest(str(folder))
+    assert manifest.complete
+    for i in range(1, 4):
+        entry = manifest.get(f"Part{i:02d}.mp3")
+        assert entry["done"] and entry["id3"]
+        assert entry["sha256"] == hashlib.sha256((folder / f"Part{i:02d}.mp3").read_bytes()).hexdigest()
+        # The part doesn't end with a tag, so one is added
+        assert os.path.getsize(folder / f"Part{i:02d}.mp3") == stub.part_size + 128
+    assert sum(e["bytes"] for e in summary["endpoints"].values()) >= 3 * stub.part_size
+    assert summary["caches"]["media_info"]["misses"] >= 1
+
+
+def test_resumes_a_part_file(stub, id_path, tmp_path):
+    async def download(libby):
+        loan = await libby.get_loan("1000")
+        await libby.download_audiobook_mp3(loan, str(tmp_path), [lambda f, mb: None])
+
+    run(stub, id_path, download)
+    folder = next(tmp_path.rglob(DownloadManifest.filename)).parent
+    # Pretend the first part broke off half way
+    part = folder / "Part01.mp3"
+    os.replace(part, str(part) + ".part")
+    os.truncate(str(part) + ".part", stub.part_size // 2)
+    data = json.loads((folder / DownloadManifest.filename).read_text())
+    data["complete"] = False
+    data["files"]["Part01.mp3"].update(completed=stub.part_size // 2, done=False)
+    (folder / DownloadManifest.filename).write_text(json.dumps(data))
+
+    requests_before = stub.requests
+    run(stub, id_path, download)
+    assert part.read_bytes() == stub.part_data
+    assert DownloadManifest(str(folder)).complete
+    assert stub.requests > requests_before
+
+
+def test_cover_errors_are_not_saved(stub, id_path, tmp_path):
+    media_info = {"covers": {"cover150Wide": {"href": f"{stub.url}/covers/1000.jpg"},
+                             "cover300Wide": {"href": f"{stub.url}/covers/missing"}}}
+
+    async def download(libby):
+        await libby.download_covers(media_info, str(tmp_path))
+
+    run(stub, id_path, download)
+    manifest = DownloadManifest(str(tmp_path))
+    assert manifest.is_done("cover150Wide.jpg", str(tmp_path))
+    assert manifest.get("cover300Wide.jpg") == {}
+    assert not (tmp_path / "cover300Wide.jpg").exists() and not (tmp_path / "cover300Wide.jpg.part").exists()
+
+    # Tried again next time
+    requests_before = stub.requests
+    run(stub, id_path, download)
+    assert stub.requests == requests_before + 2
@@ -0,0 +1,61 @@
+import hashlib
+import os
+
+from pylibby import DownloadManifest
+
+
+def make_part(stub, folder, data: bytes, completed: int, size: int):
+    # What an interrupted download leaves behind: a .part file and a manifest entry saying how far it got
+    with open(os.path.join(folder, "Part01.mp3.part"), "wb") as w:
+        w.write(data)
+    manifest = DownloadManifest(folder)
+    manifest.update("Part01.mp3", url=f"{stub.url}/web/1000/Part01.mp3", size=size, completed=completed, done=False,
+                    etag='"' + hashlib.md5(stub.part_data).hexdigest() + '"', last_modified=None)
+    return manifest
+
+
+def download(libby, stub, folder, manifest=None) -> bytes:
+    file_path = libby.download_part(f"{stub.url}/web/1000/Part01.mp3", folder, lambda f, mb: None, manifest,
+                                    stub.part_size)
+    with open(file_path, "rb") as r:
+        return r.read()
+
+
+def get_bytes(libby) -> int:
+    # Bytes of part bodies the server sent
+    return sum(e["bytes"] for endpoint, e in libby.stats.summary()["endpoints"].items() if endpoint.endswith("/{file}"))
+
+
+def test_fresh_download(libby, stub, tmp_path):
+    folder = str(tmp_path)
+    assert download(libby, stub, folder) == stub.part_data
+    entry = DownloadManifest(folder).get("Part01.mp3")
+    assert entry["done"] and entry["size"] == entry["completed"] == stub.part_size
+    assert not os.path.exists(os.path.join(folder, "Part01.mp3.part"))
+
+
+def test_resumes_where_it_stopped(libby, stub, tmp_path):
+    folder = str(tmp_path)
+    half = stub.part_size // 2
+    manifest = make_part(stub, folder, stub.part_data[:half], half, stub.part_size)
+    assert download(libby, stub, folder, manifest) == stub.part_data
+    assert get_bytes(libby) == stub.part_size - half
+
+
+def test_416_when_everything_was_there(libby, stub, tmp_path):
+    folder = str(tmp_path)
+    manifest = make_part(stub, folder, stub.part_data, stub.part_size, stub.part_size)
+    assert download(libby, stub, folder, manifest) == stub.part_data
+    assert get_bytes(libby) == 0
+    assert manifest.get("Part01.mp3")["done"]
+
+
+def test_stale_part_bigger_than_the_file_starts_over(libby, stub, tmp_path):
+    # Left from an older, bigger version of the file, the server answers the Range with 416
+    folder = str(tmp_path)
+    stale = stub.part_data + b"x" * 500
+    manifest = make_part(stub, folder, stale, len(stale), len(stale))
+    assert download(libby, stub, folder, manifest) == stub.part_data
+    entry = manifest.get("Part01.mp3")
+    assert entry["done"] and entry["size"] == stub.part_size
+    assert get_bytes(libby) == stub.part_size
@@ -0,0 +1,78 @@
+import collections
+import hashlib
+import os
+
+import pytest
+
+import pylibby
+from pylibby import DownloadManifest, DownloadQueue
+
+DiskUsage = collections.namedtuple("DiskUsage", "total used free")
+
+
+def test_priority_then_expiry_order(libby, tmp_path):
+    queue = DownloadQueue(libby, str(tmp_path / "queue.json"))
+    loans = {loan["id"]: loan for loan in libby.get_loans()}
+    queue.add(dict(loans["1000"], expireDate="2030-03-01T00:00:00Z"), "audiobook-mp3", str(tmp_path))
+    queue.add(dict(loans["1001"], expireDate="2030-02-01T00:00:00Z"), "ebook-epub-adobe", str(tmp_path))
+    queue.add(dict(loans["1002"], expireDate="2030-04-01T00:00:00Z"), "audiobook-mp3", str(tmp_path), priority=1)
+    queue.add(dict(loans["1003"], expireDate=None), "ebook-epub-adobe", str(tmp_path))
+    assert [b["id"] for b in queue.get_books()] == ["1002", "1001", "1000", "1003"]
+    # Kept between runs
+    assert [b["id"] for b in DownloadQueue(libby, str(tmp_path / "queue.json")).get_books()] == ["1002", "1001", "1000", "1003"]
+
+
+def test_runs_books_in_order_and_keeps_priorities(libby, tmp_path):
+    queue = DownloadQueue(libby, workers=1)
+    keys = queue.add_loans(libby.get_loans(), str(tmp_path))
+    queue.add(libby.get_loan("1001"), "ebook-epub-adobe", str(tmp_path), priority=5)
+    # Already queued, so the priority it was given stays
+    assert queue.add_loans(libby.get_loans(), str(tmp_path), priority=9) == []
+    assert len(keys) == 4
+    results = queue.run(lambda f, mb: None)
+    assert [(r["id"], r["status"]) for r in results] == [("1001", "ok"), ("1000", "ok"), ("1002", "ok"), ("1003", "ok")]
+    assert all(b["status"] == "done" for b in queue.get_books())
+
+
+def test_refuses_books_that_dont_fit(libby, tmp_path, monkeypatch):
+    monkeypatch.setattr(pylibby.shutil, "disk_usage", lambda path_: DiskUsage(10 ** 9, 0, 250000))
+    queue = DownloadQueue(libby, min_free=0)
+    queue.add(libby.get_loan("1000"), "audiobook-mp3", str(tmp_path))
+    (result,) = queue.run(lambda f, mb: None)
+    assert result["status"] == "error" and "Not enough disk space" in result["error"]
+    assert queue.get_books()[0]["status"] == "error"
+
+
+def test_counts_what_is_already_in_part_files(libby, stub, tmp_path, monkeypatch):
+    # 3 parts of 100000 bytes, half of the first one is already there
+    final_path = os.path.join(str(tmp_path), libby.get_download_path(libby.get_media_info("1000")))
+    os.makedirs(final_path)
+    half = stub.part_size // 2
+    with open(os.path.join(final_path, "Part01.mp3.part"), "wb") as w:
+        w.write(stub.part_data[:half])
+    DownloadManifest(final_path).update("Part01.mp3", url=f"{stub.url}/web/1000/Part01.mp3", size=stub.part_size,
+                                        completed=half, done=False,
+                                        etag='"' + hashlib.md5(stub.part_data).hexdigest() + '"')
+
+    monkeypatch.setattr(pylibby.shutil, "disk_usage", lambda path_: DiskUsage(10 ** 9, 0, 3 * stub.part_size - half))
+    queue = DownloadQueue(libby, min_free=0)
+    queue.add(libby.get_loan("1000"), "audiobook-mp3", str(tmp_path))
+    (result,) = queue.run(lambda f, mb: None)
+    assert result["status"] == "ok", result
+    with open(os.path.join(final_path, "Part01.mp3"), "rb") as r:
+        assert r.read() == stub.part_data
+
+
+def test_host_limit_below_one_is_rejected(libby):
+    with pytest.raises(ValueError):
+        DownloadQueue(libby, host_limits={"127.0.0.1": 0})
+
+
+@pytest.mark.parametrize("content", ["{not json", "[]", '{"books": []}'])
+def test_unreadable_queue_file_is_a_clear_error(libby, tmp_path, content):
+    path_ = tmp_path / "download_queue.json"
+    path_.write_text(content)
+    with pytest.raises(RuntimeError, match="Couldn't read the download queue"):
+        DownloadQueue(libby, str(path_))
+    # Left as it was, so nothing queued is lost
+    assert path_.read_text() == content
@@ -0,0 +1,47 @@
+from pylibby import MediaInfoCache, TitleIndex
+
+
+def test_get_missing_media_infos_changes_nothing(libby):
+    media_infos = {"1000": {"id": "1000"}}
+    assert libby.get_missing_media_infos(["1000", "1001"], media_infos) == ["1001"]
+    assert media_infos == {"1000": {"id": "1000"}}
+    assert libby.media_info_cache.get("1000") is None
+
+
+def test_store_media_infos_skips_errors(libby):
+    libby.title_index = TitleIndex()
+    stored = libby.store_media_infos([{"id": 1000, "title": "Title 0", "type": {"id": "audiobook"}},
+                                      {"errorCode": "NotFound"}, None])
+    assert list(stored) == ["1000"]
+    assert libby.media_info_cache.get("1000")["title"] == "Title 0"
+    assert libby.store_media_infos({"errorCode": "NotFound"}) == {}
+
+
+def test_get_media_infos_falls_back_to_one_by_one(libby, stub):
+    media_infos = libby.get_media_infos(["1001", "1000", "9999"])
+    assert list(media_infos) == ["1001", "1000", "9999"]
+    assert media_infos["1000"]["title"] == "Title 0"
+    # Not in the bulk answer, so asked for on its own, which gives an error that isn't cached
+    assert "id" not in media_infos["9999"]
+    assert libby.media_info_cache.get("1001") is not None and libby.media_info_cache.get("9999") is None
+
+
+def test_put_many_is_one_transaction_and_only_evicts_when_full(tmp_path):
+    cache = MediaInfoCache(str(tmp_path / "cache.sqlite"), max_entries=100)
+    statements = []
+    cache.db.set_trace_callback(statements.append)
+    cache.put_many({str(i): {"id": str(i)} for i in range(50)})
+    assert sum(s == "COMMIT" for s in statements) == 1
+    assert not any("NOT IN" in s for s in statements)
+
+    cache.put_many({str(i): {"id": str(i)} for i in range(50, 150)})
+    assert any("NOT IN" in s for s in statements)
+    assert cache.db.execute("SELECT COUNT(*) FROM media_info").fetchone()[0] == 100
+    # What was put last is kept
+    assert MediaInfoCache(str(tmp_path / "cache.sqlite")).get("149") == {"id": "149"}
+
+
+def test_put_is_kept_between_runs(tmp_path):
+    MediaInfoCache(str(tmp_path / "cache.sqlite")).put("1000", {"id": "1000"})
+    assert MediaInfoCache(str(tmp_path / "cache.sqlite")).get("1000") == {"id": "1000"}
+    assert MediaInfoCache(str(tmp_path / "cache.sqlite"), ttl=0).get("1000") is None
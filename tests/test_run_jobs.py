@@ -0,0 +1,31 @@
+import requests
+
+
+def test_prefetch_only_for_downloads_and_failure_is_reported(libby, tmp_path, monkeypatch):
+    calls = []
+    get_media_infos = libby.get_media_infos
+
+    def flaky_get_media_infos(title_ids, *args, **kwargs):
+        calls.append(list(title_ids))
+        if len(calls) == 1:
+            raise requests.ConnectionError("bulk lookup failed")
+        return get_media_infos(title_ids, *args, **kwargs)
+
+    monkeypatch.setattr(libby, "get_media_infos", flaky_get_media_infos)
+    jobs = [{"op": "borrow", "id": "1010", "format": None},
+            {"op": "download", "id": "1001", "format": "ebook-epub-adobe"},
+            {"op": "download", "id": "1001", "format": "ebook-epub-adobe"}]
+    results = libby.run_jobs(jobs, str(tmp_path), workers=2)
+
+    assert calls[0] == ["1001"]
+    prefetch, *job_results = results
+    assert prefetch["op"] == "prefetch" and prefetch["status"] == "error" and "bulk lookup failed" in prefetch["error"]
+    assert [(r["op"], r["status"]) for r in job_results] == [("borrow", "ok"), ("download", "ok")]
+
+
+def test_no_prefetch_without_downloads(libby, tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(libby, "get_media_infos", lambda *args, **kwargs: calls.append(args))
+    results = libby.run_jobs([{"op": "borrow", "id": "1010", "format": None}], str(tmp_path))
+    assert calls == []
+    assert [(r["op"], r["status"]) for r in results] == [("borrow", "ok")]
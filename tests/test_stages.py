@@ -0,0 +1,50 @@
+import hashlib
+
+import pytest
+
+from pylibby import DownloadManifest, HashStage, ID3Stage, PartWriter
+
+MEDIA_INFO = {"title": "Title", "publishDate": "2020-01-01T00:00:00"}
+
+
+def write(tmp_path, data: bytes, chunk_sizes: list[int], stages: list, offset: int = 0) -> str:
+    # Writes data like a download would, in chunks, starting at offset of what is already in the .part file
+    tmp_path = str(tmp_path / "Part01.mp3.part")
+    if offset:
+        with open(tmp_path, "wb") as w:
+            w.write(data[:offset])
+    manifest = DownloadManifest(str(tmp_path.rsplit("/", 1)[0]))
+    writer = PartWriter(tmp_path, offset, "Part01.mp3", manifest, lambda f, mb: None, len(data), stages)
+    position, i = offset, 0
+    while position < len(data):
+        n = chunk_sizes[i % len(chunk_sizes)]
+        writer.write(data[position:position + n])
+        position += n
+        i += 1
+    writer.close()
+    results = {}
+    with open(tmp_path, "r+b") as w:
+        for stage in stages:
+            results.update(stage.finish(w, len(data)))
+    with open(tmp_path, "rb") as r:
+        assert results["sha256"] == hashlib.sha256(r.read()).hexdigest()
+    return tmp_path
+
+
+@pytest.mark.parametrize("chunk_sizes", [[1000], [7, 300, 1], [50000]])
+@pytest.mark.parametrize("offset", [0, 100, 10000])
+def test_hash_is_of_the_tagged_file(tmp_path, chunk_sizes, offset):
+    data = bytes(range(256)) * 100
+    write(tmp_path, data, chunk_sizes, [ID3Stage(MEDIA_INFO, 1), HashStage()], offset)
+
+
+def test_existing_tag_is_replaced_and_hashed(tmp_path):
+    data = bytes(range(256)) * 100 + b"TAG" + bytes(125)
+    path_ = write(tmp_path, data, [4096], [ID3Stage(MEDIA_INFO, 2), HashStage()])
+    with open(path_, "rb") as r:
+        content = r.read()
+    assert len(content) == len(data) and content[-128:-125] == b"TAG" and content[-2] == 2
+
+
+def test_hash_without_tagging(tmp_path):
+    write(tmp_path, bytes(range(256)) * 10 + b"end", [100], [HashStage()], 60)
@@ -0,0 +1,57 @@
+import requests
+
+from pylibby import SyncMirror
+
+
+def get_sync(loans: list, holds: list = ()) -> dict:
+    return {"result": "synchronized", "cards": [{"cardId": "1", "advantageKey": "lib"}],
+            "loans": [{"id": i, "cardId": "1", "title": i, "expireDate": "2100-01-01T00:00:00Z"} for i in loans],
+            "holds": list(holds)}
+
+
+def test_reports_only_changes(tmp_path):
+    mirror = SyncMirror(str(tmp_path / "mirror.json"))
+    assert sorted(e["type"] for e in mirror.update(get_sync(["a", "b"]))) == ["card_added", "loan_added", "loan_added"]
+    assert mirror.update(get_sync(["a", "b"])) == []
+    events = mirror.update(get_sync(["b", "c"]))
+    assert sorted((e["type"], e["id"]) for e in events) == [("loan_added", "c"), ("loan_removed", "a")]
+    # The snapshot survives a restart
+    assert SyncMirror(str(tmp_path / "mirror.json")).update(get_sync(["b", "c"])) == []
+
+
+def test_expiring_and_available_are_told_once():
+    mirror = SyncMirror(expiring_days=3)
+    sync = get_sync([])
+    sync["loans"] = [{"id": "a", "cardId": "1", "expireDate": "2000-01-01T00:00:00Z"}]
+    sync["holds"] = [{"id": "h", "cardId": "1", "isAvailable": True}]
+    types = [e["type"] for e in mirror.update(sync)]
+    assert "loan_expiring" in types and "hold_available" in types
+    assert mirror.update(sync) == []
+
+
+def test_failed_sync_changes_nothing():
+    mirror = SyncMirror()
+    mirror.update(get_sync(["a"]))
+    assert mirror.update({"result": "error"}) == []
+    assert mirror.update({"errorCode": "InternalError"}) == []
+    assert mirror.update(get_sync(["a"])) == []
+
+
+def test_watch_keeps_polling_after_errors(libby, monkeypatch):
+    replies = [requests.ConnectionError("down"), ValueError("not json"), {"result": "missing_chip"},
+               get_sync(["a"]), get_sync(["a", "b"])]
+
+    def get_sync_(max_age=None):
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    monkeypatch.setattr(libby, "get_sync", get_sync_)
+    monkeypatch.setattr("pylibby.time.sleep", lambda seconds: None)
+    events = []
+    for event in libby.watch(SyncMirror(), 1, 10):
+        events.append(event)
+        if not replies:
+            break
+    assert [(e["type"], e["id"]) for e in events] == [("card_added", "1"), ("loan_added", "a"), ("loan_added", "b")]
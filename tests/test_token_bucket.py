@@ -0,0 +1,32 @@
+import time
+
+import pytest
+
+from pylibby_common import TokenBucket
+
+
+def test_burst_goes_through_then_rate_is_kept():
+    bucket = TokenBucket(20, 5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.05
+    for _ in range(4):
+        bucket.acquire()
+    # 4 more at 20 per second
+    assert time.monotonic() - start >= 0.18
+
+
+def test_acquire_more_than_burst_is_paid_back():
+    bucket = TokenBucket(100, 10)
+    bucket.acquire(30)
+    start = time.monotonic()
+    bucket.acquire()
+    # 20 owed plus the one asked for
+    assert time.monotonic() - start >= 0.19
+
+
+@pytest.mark.parametrize("rate, burst", [(0, None), (-1, None), (float("nan"), None), (10, 0), (10, -5)])
+def test_rejects_rates_that_never_let_anything_through(rate, burst):
+    with pytest.raises(ValueError):
+        TokenBucket(rate, burst)
@@ -0,0 +1,101 @@
+import email.utils
+import time
+
+import pytest
+import requests
+
+from pylibby_common import Stats
+from pylibby_transport import LibbyAdapter
+
+
+def get_session(stub, stats: Stats, **kwargs) -> requests.Session:
+    session = requests.Session()
+    adapter = LibbyAdapter(stats=stats, backoff=0.01, **kwargs)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_events(stats: Stats, type_: str) -> list[dict]:
+    events = []
+    stats.add_hook(lambda e: events.append(e) if e["type"] == type_ else None)
+    return events
+
+
+def test_read_timeout_is_retried_for_get(stub):
+    stats = Stats()
+    stub.latency = 0.5
+    retries = get_events(stats, "retry")
+    # The server gets fast again after the first timeout
+    stats.add_hook(lambda e: setattr(stub, "latency", 0) if e["type"] == "retry" else None)
+    session = get_session(stub, stats, retries=3, timeouts={"127.0.0.1": (1, 0.1)})
+    assert session.get(f"{stub.url}/v2/media/1000").json()["id"] == "1000"
+    assert len(retries) == 1
+
+
+def test_read_timeout_gives_up_after_retries(stub):
+    stats = Stats()
+    stub.latency = 0.3
+    session = get_session(stub, stats, retries=2, timeouts={"127.0.0.1": (1, 0.05)})
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        session.get(f"{stub.url}/v2/media/1000")
+    (endpoint,) = stats.summary()["endpoints"].values()
+    assert endpoint["calls"] == 3 and endpoint["retries"] == 2
+
+
+def test_read_timeout_is_not_retried_for_post(stub):
+    stats = Stats()
+    stub.latency = 0.3
+    session = get_session(stub, stats, retries=2, timeouts={"127.0.0.1": (1, 0.05)})
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        session.post(f"{stub.url}/chip")
+    (endpoint,) = stats.summary()["endpoints"].values()
+    assert endpoint["calls"] == 1 and endpoint["retries"] == 0
+
+
+def test_503_is_retried_with_retry_after(stub):
+    stats = Stats()
+    stub.error_rate = 1.0
+    retries = get_events(stats, "retry")
+    stats.add_hook(lambda e: setattr(stub, "error_rate", 0) if e["type"] == "retry" and e["attempt"] == 2 else None)
+    session = get_session(stub, stats, retries=5)
+    resp = session.get(f"{stub.url}/v2/media/1000")
+    assert resp.status_code == 200
+    # The stub says Retry-After: 0, which is used instead of the backoff
+    assert [e["delay"] for e in retries] == [0, 0]
+
+
+def test_503_gives_up_after_retries_and_post_is_not_retried(stub):
+    stats = Stats()
+    stub.error_rate = 1.0
+    session = get_session(stub, stats, retries=2)
+    assert session.get(f"{stub.url}/v2/media/1000").status_code == 503
+    assert session.post(f"{stub.url}/chip").status_code == 503
+    summary = stats.summary()["endpoints"]
+    assert [(e["calls"], e["retries"]) for e in summary.values()] == [(3, 2), (1, 0)]
+
+
+def test_get_retry_after():
+    adapter = LibbyAdapter(max_backoff=60)
+
+    class Response:
+        def __init__(self, value):
+            self.headers = {"Retry-After": value} if value is not None else {}
+
+    assert adapter.get_retry_after(Response("3")) == 3
+    assert adapter.get_retry_after(Response("600")) == 60
+    assert adapter.get_retry_after(Response(None)) is None
+    assert adapter.get_retry_after(Response("soon")) is None
+    when = adapter.get_retry_after(Response(email.utils.formatdate(time.time() + 10, usegmt=True)))
+    assert 8 < when <= 10
+
+
+def test_backoff_grows_and_is_capped():
+    adapter = LibbyAdapter(backoff=1, max_backoff=8)
+    for attempt, delay in [(0, 1), (2, 4), (10, 8)]:
+        assert delay / 2 <= adapter.get_backoff(attempt) <= delay
+
+
+@pytest.mark.parametrize("n", [0, -1])
+def test_host_limit_below_one_is_rejected(n):
+    with pytest.raises(ValueError):
+        LibbyAdapter(host_limits={"127.0.0.1": n})